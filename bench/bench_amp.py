@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+''' benchmark fit() in fp32 v bf16 autocast on the demo slice
+    reports iterations/sec + psnr/ssim of the data-consistent recon w.r.t. gt
+    e.g. python bench/bench_amp.py --num_iter 1000 --device cpu '''
+
+import time
+import numpy as np
+import torch
+import argparse
+
+from include.decoder_conv import init_convdecoder
+from include.fit import fit
+from utils.evaluate import psnr, ssim
+from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
+                            reshape_adj_channels_to_complex_vals, crop_center
+from utils.device import set_device
+from bench.demo_slice import load_demo_slice, DIM
+
+AMP_DTYPES = {'fp32': None, 'bf16': torch.bfloat16}
+
+
+def run_bench(args):
+
+    ksp_orig, mask, _ = load_demo_slice(args.num_coils, args.accel)
+
+    results = {}
+    for name in args.modes:
+
+        # same seed for each mode, i.e. identical init + k-space scaling
+        net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, dtype=args.dtype)
+        ksp_masked = ksp_orig_ * mask
+
+        t0 = time.time()
+        net, info = fit(ksp_masked, net, net_input, mask, num_iter=args.num_iter,
+                        dtype=args.dtype, return_info=True,
+                        amp_dtype=AMP_DTYPES[name])
+        t_fit = time.time() - t0
+
+        img_dc = get_dc_img(net, net_input, ksp_masked, mask, args.dtype)
+        img_gt = crop_center(root_sum_squares(ifft_2d(ksp_orig_)), DIM, DIM).numpy()
+
+        results[name] = {'iter_per_sec': info['num_iter'] / t_fit,
+                         'psnr': psnr(img_gt, img_dc), 'ssim': ssim(img_gt, img_dc)}
+        print('{}: {:.2f} iter/s, psnr {:.3f}, ssim {:.4f}'.format(name,
+                *[results[name][k] for k in ['iter_per_sec', 'psnr', 'ssim']]))
+
+    if 'fp32' in results:
+        for name in results:
+            if name == 'fp32':
+                continue
+            print('{} v fp32: {:.2f}x iter/s, psnr {:+.3f}, ssim {:+.4f}'.format(name,
+                    results[name]['iter_per_sec'] / results['fp32']['iter_per_sec'],
+                    results[name]['psnr'] - results['fp32']['psnr'],
+                    results[name]['ssim'] - results['fp32']['ssim']))
+
+    return results
+
+def get_dc_img(net, net_input, ksp_masked, mask, dtype):
+    ''' perform dc step on net output, return cropped rss img '''
+
+    with torch.no_grad():
+        img_out = net(net_input.type(dtype))
+    img_out = reshape_adj_channels_to_complex_vals(img_out[0]).cpu()
+    ksp_dc = torch.where(mask.bool(), ksp_masked, fft_2d(img_out))
+
+    return crop_center(root_sum_squares(ifft_2d(ksp_dc)), DIM, DIM).numpy()
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--modes', nargs='+', default=['fp32', 'bf16'])
+    parser.add_argument('--num_iter', type=int, default=1000)
+    parser.add_argument('--num_coils', type=int, default=8) # if synthesizing k-space
+    parser.add_argument('--accel', type=int, default=4)
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+
+    args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
+
+    run_bench(args)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+''' benchmark per-iteration time of fit() w eager v torch.compile'd steps on the demo slice
+    compilation happens in a warmup fit, s.t. timings exclude it, as compiled steps
+    are cached + reused by every later fit of the same architecture + img shape
+    e.g. python bench/bench_compile.py --num_iter 50 --device cpu '''
+
+import time
+import torch
+import argparse
+
+from include.decoder_conv import init_convdecoder
+from include.fit import fit
+from utils.device import set_device
+from bench.demo_slice import load_demo_slice
+
+
+def run_bench(args):
+
+    ksp_orig, mask, _ = load_demo_slice(args.num_coils, args.accel)
+
+    results = {}
+    for name, compile in [('eager', False), ('compiled', True)]:
+
+        net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, num_channels=args.num_channels,
+                                                     dtype=args.dtype)
+        ksp_masked = ksp_orig_ * mask
+        kwargs = {'dtype': args.dtype, 'compile': compile}
+
+        t0 = time.time() # warmup, incl compilation
+        fit(ksp_masked, net, net_input, mask, num_iter=args.num_warmup, **kwargs)
+        t_warmup = time.time() - t0
+
+        t0 = time.time()
+        fit(ksp_masked, net, net_input, mask, num_iter=args.num_iter, **kwargs)
+        results[name] = (time.time() - t0) / args.num_iter
+
+        print('{}: {:.4f} s/iter, warmup {:.1f}s'.format(name, results[name], t_warmup))
+
+    print('compiled v eager: {:.2f}x speedup per iter'.format(
+                                        results['eager'] / results['compiled']))
+
+    return results
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--num_iter', type=int, default=50)
+    parser.add_argument('--num_warmup', type=int, default=3)
+    parser.add_argument('--num_channels', type=int, default=160)
+    parser.add_argument('--num_coils', type=int, default=8) # if synthesizing k-space
+    parser.add_argument('--accel', type=int, default=4)
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+
+    args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
+
+    run_bench(args)
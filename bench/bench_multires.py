@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+''' benchmark wall-clock time to reach a target loss on the demo slice w
+    single resolution fit() v coarse-to-fine fit_multires()
+    default target is the best loss of a reference fit() w num_iter_ref iterations
+    e.g. python bench/bench_multires.py --num_iter_ref 2000 --device cpu '''
+
+import time
+import torch
+import argparse
+
+from include.decoder_conv import init_convdecoder
+from include.fit import fit
+from include.multires import fit_multires
+from include.stopping import TargetLoss
+from utils.device import set_device
+from bench.demo_slice import load_demo_slice
+
+
+def run_bench(args):
+
+    ksp_orig, mask, _ = load_demo_slice(args.num_coils, args.accel)
+
+    def init(): # same seed for every run, i.e. identical init + k-space scaling
+        net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, num_channels=args.num_channels,
+                                                     dtype=args.dtype)
+        return net, net_input, ksp_orig_ * mask
+
+    target = args.target_loss
+    if target is None:
+        net, net_input, ksp_masked = init()
+        _, info = fit(ksp_masked, net, net_input, mask, num_iter=args.num_iter_ref,
+                      dtype=args.dtype, return_info=True)
+        target = info['best_loss']
+        print('target loss {:.4e}, from reference fit w {} iters'.format(
+                                                        target, args.num_iter_ref))
+
+    # single resolution
+    net, net_input, ksp_masked = init()
+    t0 = time.time()
+    _, info = fit(ksp_masked, net, net_input, mask, num_iter=args.num_iter_max,
+                  dtype=args.dtype, stop_criteria=[TargetLoss(target)], return_info=True)
+    t_single = time.time() - t0
+    print('single res: {:.1f}s, {} iters, stop {}'.format(t_single, info['num_iter'],
+                                                          info['stop_reason']))
+
+    # coarse-to-fine
+    net, net_input, ksp_masked = init()
+    t0 = time.time()
+    _, info = fit_multires(ksp_masked, net, net_input, mask, args.block_list,
+                           args.num_iter_coarse + [args.num_iter_max], dtype=args.dtype,
+                           stop_criteria=[TargetLoss(target)], return_info=True)
+    t_multi = time.time() - t0
+    for num_blocks, size, num_iter, t_stage in info['stages']:
+        print('  {} blocks, size {}: {} iters, {:.1f}s'.format(num_blocks, size,
+                                                               num_iter, t_stage))
+    print('multires: {:.1f}s, stop {}'.format(t_multi, info['stop_reason']))
+
+    print('multires v single res: {:.2f}x time to target'.format(t_multi / t_single))
+
+    return t_single, t_multi
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--target_loss', type=float, default=None) # default from reference fit
+    parser.add_argument('--num_iter_ref', type=int, default=1000)
+    parser.add_argument('--num_iter_max', type=int, default=10000) # cap per full res fit
+    parser.add_argument('--block_list', nargs='+', type=int, default=[4, 6, 7])
+    parser.add_argument('--num_iter_coarse', nargs='+', type=int, default=[200, 200])
+    parser.add_argument('--num_channels', type=int, default=160)
+    parser.add_argument('--num_coils', type=int, default=8) # if synthesizing k-space
+    parser.add_argument('--accel', type=int, default=4)
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+
+    args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
+
+    run_bench(args)
@@ -0,0 +1,45 @@
+''' demo slice shared by the benchmarks in bench/
+
+    uses the fastmri demo k-space (demo/data/in_ksp.npy) if present. otherwise
+    synthesizes multi-coil k-space from the demo gt image w smooth gaussian 
+    coil sensitivities, s.t. benchmarks run w/o access to any dataset '''
+
+import os
+import numpy as np
+import torch
+
+from utils.data_io import load_h5_fastmri, get_mask
+from utils.transform import fft_2d, ifft_2d, root_sum_squares, crop_center
+
+path_demo = os.path.abspath(os.path.join(os.path.dirname(__file__),'..')) + '/demo/data/'
+DIM = 320 # size of demo gt
+
+
+def load_demo_slice(num_coils=8, accel=4):
+    ''' return ksp_orig complex dim (nc,x,y), 1D mask over y, gt rss img dim (DIM,DIM) '''
+
+    if os.path.exists(path_demo + 'in_ksp.npy'):
+        ksp_orig = load_h5_fastmri(file_id=None, demo=True)
+    else:
+        ksp_orig = synthesize_ksp(np.load(path_demo + 'gt.npy'), num_coils)
+
+    mask = get_mask(ksp_orig, accelerations=[accel])
+    img_gt = crop_center(root_sum_squares(ifft_2d(ksp_orig)), DIM, DIM)
+
+    return ksp_orig, mask, img_gt
+
+def synthesize_ksp(img, num_coils):
+    ''' given real img dim (x,y), return k-space of num_coils coils w gaussian 
+        sensitivities centered around the image border + a smooth phase '''
+
+    nx, ny = img.shape
+    xx, yy = np.meshgrid(np.linspace(-1, 1, nx), np.linspace(-1, 1, ny), indexing='ij')
+    phase = np.exp(1j * np.pi * 0.5 * (xx + yy))
+
+    coils = []
+    for c in range(num_coils):
+        angle = 2 * np.pi * c / num_coils
+        dist2 = (xx - np.cos(angle))**2 + (yy - np.sin(angle))**2
+        coils.append(img * np.exp(-dist2) * phase)
+
+    return fft_2d(torch.from_numpy(np.stack(coils).astype(np.complex64)))
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+''' microbenchmarks of the reconstruction hot paths on synthetic data shaped like
+    our workloads, i.e. qdess [16,512,160] w the pd_{4,8}x_calib64 masks and
+    fastmri [15,640,368] w get_mask(). results are saved as json s.t. the effect
+    of any change can be measured, e.g.
+
+        python bench/run_bench.py --out base.json        # before change
+        python bench/run_bench.py --baseline base.json   # after, prints ratios
+        python bench/run_bench.py --compare base.json new.json
+
+    each case reports the median, min, max seconds per call over repeat runs.
+    cases which raise, e.g. utils.evaluate w/o matplotlib, are reported as skipped '''
+
+import re
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import torch
+import argparse
+
+from utils.device import set_device, get_device
+
+WORKLOADS = {'qdess': (16, 512, 160), 'fastmri': (15, 640, 368)}
+CASES = {} # name --> (func, workloads), func(args, workload) returns fn to time
+
+
+def case(name, workloads=('qdess', 'fastmri')):
+    ''' register a benchmark case, run once per workload '''
+    def register(func):
+        CASES[name] = (func, workloads)
+        return func
+    return register
+
+###### synthetic data ######
+def get_ksp(workload, seed=0):
+    ''' complex gaussian k-space dim (nc,x,y) '''
+    gen = torch.Generator().manual_seed(seed)
+    shape = WORKLOADS[workload]
+    return torch.complex(torch.randn(shape, generator=gen),
+                         torch.randn(shape, generator=gen))
+
+def get_workload_mask(workload, accel=4):
+    ''' 2D qdess mask from the mask registry, or 1D fastmri mask over y '''
+    if workload == 'qdess':
+        from include.mri_helpers import get_mask_registry
+        return get_mask_registry().get(accel, 64)
+    from utils.data_io import get_mask
+    return get_mask(get_ksp(workload), accelerations=[accel])
+
+def get_imgs(workload, noise=0.05, seed=0):
+    ''' (gt, out) rss imgs dim (x,y), w out a noisy copy of gt '''
+    from utils.transform import ifft_2d, root_sum_squares
+    img_gt = root_sum_squares(ifft_2d(get_ksp(workload, seed))).numpy()
+    rng = np.random.RandomState(seed)
+    img_out = img_gt + noise * img_gt.std() * rng.randn(*img_gt.shape)
+    return img_gt, img_out.astype(img_gt.dtype)
+
+###### cases ######
+@case('fft_2d')
+def bench_fft_2d(args, workload):
+    from utils.transform import fft_2d
+    ksp = get_ksp(workload).to(args.device)
+    return lambda: fft_2d(ksp)
+
+@case('ifft_2d')
+def bench_ifft_2d(args, workload):
+    from utils.transform import ifft_2d
+    ksp = get_ksp(workload).to(args.device)
+    return lambda: ifft_2d(ksp)
+
+@case('roll')
+def bench_roll(args, workload):
+    from utils.transform import roll
+    ksp = get_ksp(workload).to(args.device)
+    return lambda: roll(ksp, ksp.shape[-1] // 2, dim=-1)
+
+@case('fftshift')
+def bench_fftshift(args, workload):
+    from utils.transform import fftshift
+    ksp = get_ksp(workload).to(args.device)
+    return lambda: fftshift(ksp, dim=(-2,-1))
+
+@case('reshape_complex_to_adj')
+def bench_reshape_complex_to_adj(args, workload):
+    from utils.transform import reshape_complex_vals_to_adj_channels
+    ksp = get_ksp(workload).to(args.device)
+    return lambda: reshape_complex_vals_to_adj_channels(ksp)
+
+@case('reshape_adj_to_complex')
+def bench_reshape_adj_to_complex(args, workload):
+    from utils.transform import reshape_complex_vals_to_adj_channels, \
+                                reshape_adj_channels_to_complex_vals
+    img = reshape_complex_vals_to_adj_channels(get_ksp(workload)).to(args.device)
+    return lambda: reshape_adj_channels_to_complex_vals(img)
+
+@case('forwardm')
+def bench_forwardm(args, workload):
+    from include.fit import forwardm
+    from utils.transform import reshape_complex_vals_to_adj_channels
+    img = reshape_complex_vals_to_adj_channels(get_ksp(workload))[None].to(args.device)
+    mask = get_workload_mask(workload).to(args.device)
+    return lambda: forwardm(img, mask)
+
+@case('forward_op')
+def bench_forward_op(args, workload):
+    from include.fit import ForwardOp
+    from utils.transform import reshape_complex_vals_to_adj_channels
+    img = reshape_complex_vals_to_adj_channels(get_ksp(workload))[None].to(args.device)
+    A = ForwardOp(get_workload_mask(workload), device=args.device)
+    return lambda: A(img)
+
+@case('init_convdecoder')
+def bench_init_convdecoder(args, workload):
+    from include.decoder_conv import init_convdecoder
+    ksp = get_ksp(workload)
+    return lambda: init_convdecoder(ksp, num_channels=args.num_channels, dtype=args.dtype)
+
+@case('fit_iter')
+def bench_fit_iter(args, workload):
+    ''' one iteration of fit(), i.e. forward, loss, backward, adam step '''
+    from include.decoder_conv import init_convdecoder
+    from include.fit import ForwardOp, get_fit_step
+    from utils.transform import ifft_2d, reshape_complex_vals_to_adj_channels
+
+    net, net_input, ksp_orig_ = init_convdecoder(get_ksp(workload),
+                                        num_channels=args.num_channels, dtype=args.dtype)
+    net_input = net_input.type(args.dtype)
+    mask = get_workload_mask(workload)
+    img_masked = reshape_complex_vals_to_adj_channels(ifft_2d(ksp_orig_ * mask))[None]
+    img_masked = img_masked.to(args.device)
+    A = ForwardOp(mask, device=args.device)
+    step = get_fit_step(net, net_input, img_masked)
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.01)
+
+    def fit_iter():
+        optimizer.zero_grad()
+        step(net, net_input, img_masked, A, 1e-8, None)
+        optimizer.step()
+
+    return fit_iter
+
+@case('calc_metrics', workloads=('qdess',))
+def bench_calc_metrics(args, workload):
+    from utils.evaluate import calc_metrics
+    from utils.hfen import get_hfen
+    img_gt, img_out = get_imgs(workload)
+    return lambda: calc_metrics(img_gt, img_out, get_hfen())
+
+@case('calc_metrics_batch', workloads=('qdess',))
+def bench_calc_metrics_batch(args, workload):
+    ''' 8 imgs per call, i.e. divide by 8 to compare w calc_metrics '''
+    from utils.metrics import calc_metrics_batch
+    imgs = [get_imgs(workload, seed=seed) for seed in range(8)]
+    imgs_gt, imgs_out = np.stack([im[0] for im in imgs]), np.stack([im[1] for im in imgs])
+    return lambda: calc_metrics_batch(imgs_gt, imgs_out)
+
+def get_hfen_case(args, workload, fft):
+    ''' 8 imgs per call '''
+    from utils.hfen import HFENLoss
+    imgs = [get_imgs(workload, seed=seed) for seed in range(8)]
+    imgs_gt, imgs_out = [torch.from_numpy(np.stack([im[idx] for im in imgs]))[:, None]
+                         for idx in range(2)]
+    imgs_gt, imgs_out = imgs_gt.to(args.device), imgs_out.to(args.device)
+    hfen = HFENLoss(fft=fft)
+    return lambda: hfen.forward_batch(imgs_gt, imgs_out)
+
+@case('hfen_conv')
+def bench_hfen_conv(args, workload):
+    return get_hfen_case(args, workload, fft=False)
+
+@case('hfen_fft')
+def bench_hfen_fft(args, workload):
+    return get_hfen_case(args, workload, fft=True)
+
+@case('generate_t2_map', workloads=('qdess',))
+def bench_generate_t2_map(args, workload):
+    from include.mri_helpers import generate_t2_map
+    echo1, _ = get_imgs(workload, seed=0)
+    echo2 = 0.5 * get_imgs(workload, seed=1)[0]
+    return lambda: generate_t2_map(echo1, echo2)
+
+###### timing ######
+def time_fn(fn, device, repeat=5, min_time=0.2):
+    ''' return list of seconds per call over repeat runs. each run makes enough
+        calls to take >= min_time, after one warmup call to estimate this '''
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    sync()
+    t0 = time.perf_counter()
+    fn()
+    sync()
+    number = max(1, int(min_time / max(time.perf_counter() - t0, 1e-9)))
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        sync()
+        times.append((time.perf_counter() - t0) / number)
+
+    return times
+
+def run_bench(args):
+
+    results = {}
+    for name, (func, workloads) in CASES.items():
+        for workload in workloads:
+            key = '{}/{}'.format(name, workload)
+            if args.filter and not re.search(args.filter, key):
+                continue
+            try:
+                fn = func(args, workload)
+                times = time_fn(fn, args.device, args.repeat, args.min_time)
+            except Exception as e: # e.g. missing dependency, report + carry on
+                results[key] = {'skipped': repr(e)}
+                print('{:<36} skipped: {!r}'.format(key, e))
+                continue
+            results[key] = {'median': float(np.median(times)), 'min': min(times),
+                            'max': max(times), 'repeat': len(times)}
+            print('{:<36} {:>10.3f} ms'.format(key, 1e3 * results[key]['median']))
+
+    return {'meta': get_meta(args), 'results': results}
+
+def get_meta(args):
+    ''' environment of a run, s.t. results are only compared like for like '''
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(), 'python': platform.python_version(),
+            'torch': torch.__version__, 'numpy': np.__version__,
+            'device': str(args.device), 'num_threads': torch.get_num_threads(),
+            'num_channels': args.num_channels}
+
+def compare(base, new, threshold=0.05):
+    ''' print median time of each case in new relative to base
+        flag cases slower or faster by more than a relative threshold '''
+
+    for k in ['commit', 'device', 'num_threads', 'torch']:
+        if base['meta'].get(k) != new['meta'].get(k):
+            print('note: {} differs, {} v {}'.format(k, base['meta'].get(k),
+                                                     new['meta'].get(k)))
+
+    print('{:<36} {:>10} {:>10} {:>8}'.format('case', 'base ms', 'new ms', 'ratio'))
+    for key in sorted(set(base['results']) | set(new['results'])):
+        r_base, r_new = base['results'].get(key, {}), new['results'].get(key, {})
+        if 'median' not in r_base or 'median' not in r_new:
+            continue
+        ratio = r_new['median'] / r_base['median']
+        flag = 'slower' if ratio > 1 + threshold else \
+               'faster' if ratio < 1 - threshold else ''
+        print('{:<36} {:>10.3f} {:>10.3f} {:>7.2f}x {}'.format(key,
+                1e3 * r_base['median'], 1e3 * r_new['median'], ratio, flag))
+
+def load_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default='cpu') # e.g. cpu, cuda:2
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--filter', type=str, default=None) # regex on case/workload, e.g. fft
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min_time', type=float, default=0.2) # min seconds per run
+    parser.add_argument('--num_channels', type=int, default=160)
+    parser.add_argument('--out', type=str, default=None) # save results to json
+    parser.add_argument('--baseline', type=str, default=None) # compare results to json
+    parser.add_argument('--compare', nargs=2, default=None) # compare two jsons, no run
+    parser.add_argument('--threshold', type=float, default=0.05) # rel change to flag
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+
+    args = init_parser()
+
+    if args.compare:
+        compare(*[load_json(fn) for fn in args.compare], args.threshold)
+        sys.exit()
+
+    args.dtype = set_device(args.device, args.num_threads)
+    args.device = get_device(args.dtype)
+
+    out = run_bench(args)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(out, f, indent=2)
+    if args.baseline:
+        compare(load_json(args.baseline), out, args.threshold)
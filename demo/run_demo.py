@@ -12,11 +12,9 @@ from utils.data_io import load_h5_fastmri, get_mask
 from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
                             reshape_adj_channels_to_complex_vals, \
                             crop_center
+from utils.device import set_device
 
-if torch.cuda.is_available():
-    dtype = torch.cuda.FloatTensor
-else: 
-    torch.FloatTensor
+dtype = set_device() # gpu if available, else cpu w all cores
 dim = 320
 
 def run_demo():
@@ -25,14 +23,14 @@ def run_demo():
     
     mask = get_mask(ksp_orig)
 
-    net, net_input, ksp_orig_ = init_convdecoder(ksp_orig)
+    net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, dtype=dtype)
 
     ksp_masked = 0.1 * ksp_orig_ * mask 
 
-    net = fit(ksp_masked, net, net_input, mask)
+    net = fit(ksp_masked, net, net_input, mask, dtype=dtype)
 
     img_out = net(net_input.type(dtype))
-    img_out = reshape_adj_channels_to_complex_vals(img_out[0])
+    img_out = reshape_adj_channels_to_complex_vals(img_out[0]).cpu()
     ksp_est = fft_2d(img_out)
     ksp_dc = torch.where(mask, ksp_masked, ksp_est)
 
@@ -1,7 +1,18 @@
 #!/bin/bash
-
 #SBATCH --output=log/slurm-%j.out
 #SBATCH --error=log/slurm-%j.err
+#SBATCH --open-mode=append
 #SBATCH --gres=gpu:1
+#SBATCH --requeue
+#SBATCH --signal=B:TERM@120
+
+# on preemption or 2 min before the time limit, forward SIGTERM to python s.t. fit()
+# saves a checkpoint + exits, and the job queue releases the job, then requeue. the
+# requeued job resumes from the checkpoint + the job queue skips recons already done
+trap 'kill -TERM $PID; wait $PID; scontrol requeue $SLURM_JOB_ID' TERM
 
-python3 run_qdess.py --dir_out delete_me --file_id_list 006 --num_iter 10
+python3 run_qdess.py --dir_out delete_me --file_id_list 006 --num_iter 10 \
+                     --queue /bmrNAS/people/dvv/out_qdess/queue_delete_me.db \
+                     --ckpt_dir /bmrNAS/people/dvv/out_qdess/ckpt &
+PID=$!
+wait $PID
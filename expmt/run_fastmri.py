@@ -7,21 +7,28 @@
 import os, sys
 import numpy as np
 import torch
+import argparse
 
-from utils.data_io import get_mask
+from utils.data_io import get_mask, load_h5_fastmri
+from utils.device import set_device
 from include.decoder_conv import init_convdecoder
 from include.fit import fit
 from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
                             reshape_adj_channels_to_complex_vals, \
-                            crop_center
+                            crop_center, get_coil_compression, coil_compress
 
-dtype = torch.cuda.FloatTensor
 path_out = '/bmrNAS/people/dvv/out_fastmri/'
 dim = 320
 
-def run_expmt(file_id_list):
+TEST_SET = ['1000000', '1000007', '1000017', '1000026', '1000031', '1000033', '1000041', '1000052',
+            '1000071', '1000073', '1000107', '1000108', '1000114', '1000126', '1000153', '1000178',
+            '1000182', '1000190', '1000196', '1000201', '1000206', '1000229', '1000243', '1000247',
+            '1000254', '1000263', '1000264', '1000267', '1000273', '1000277', '1000280', '1000283',
+            '1000291', '1000292', '1000308', '1000325', '1000464', '1000537']
 
-    for file_id in file_id_list:
+def run_expmt(args):
+
+    for file_id in args.file_id_list:
 
         if os.path.exists('{}{}_dc.npy'.format(path_out, file_id)):
             continue
@@ -31,14 +38,20 @@ def run_expmt(file_id_list):
 
         mask = get_mask(ksp_orig)
 
-        net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, mask)
+        # optionally compress coils, w svd of the measured samples only
+        ksp_fit = ksp_orig
+        if args.num_vcoils or args.cc_energy:
+            cc_mat = get_coil_compression(ksp_orig * mask, args.num_vcoils, args.cc_energy)
+            ksp_fit = coil_compress(ksp_orig, cc_mat)
+
+        net, net_input, ksp_orig_ = init_convdecoder(ksp_fit, dtype=args.dtype)
 
         ksp_masked = 0.1 * ksp_orig_ * mask 
 
-        net = fit(ksp_masked, net, net_input, mask)
+        net = fit(ksp_masked, net, net_input, mask, dtype=args.dtype)
 
-        img_out = net(net_input.type(dtype))
-        img_out = reshape_adj_channels_to_complex_vals(img_out[0])
+        img_out = net(net_input.type(args.dtype))
+        img_out = reshape_adj_channels_to_complex_vals(img_out[0]).cpu()
         ksp_est = fft_2d(img_out)
         ksp_dc = torch.where(mask, ksp_masked, ksp_est)
 
@@ -51,14 +64,23 @@ def run_expmt(file_id_list):
         np.save('{}{}_gt.npy'.format(path_out, file_id), img_gt)
 
 
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--file_id_list', nargs='+', default=TEST_SET)
+    parser.add_argument('--num_vcoils', type=int, default=None) # virtual coils after compression
+    parser.add_argument('--cc_energy', type=float, default=None) # ... or keep this energy, e.g. 0.95
+
+    args = parser.parse_args()
+
+    return args
+
 if __name__ == '__main__':
 
-    test_set = ['1000000', '1000007',
-                '1000017', '1000026', '1000031', '1000033', '1000041', '1000052',
-                '1000071', '1000073', '1000107', '1000108', '1000114', '1000126',
-                '1000153', '1000178', '1000182', '1000190', '1000196', '1000201',
-                '1000206', '1000229', '1000243', '1000247', '1000254', '1000263',
-                '1000264', '1000267', '1000273', '1000277', '1000280', '1000283', 
-                '1000291', '1000292', '1000308', '1000325', '1000464', '1000537']
+    args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
 
-    run_expmt(test_set)
+    run_expmt(args)
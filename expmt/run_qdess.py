@@ -7,12 +7,15 @@ import argparse
 
 from include.decoder_conv import init_convdecoder
 from include.fit import fit
+from include.stopping import get_stop_criteria
 from include.mri_helpers import apply_mask
-from utils.data_io import load_qdess
+from include.checkpoint import get_preemption
+from utils.data_io import load_qdess, save_npy_atomic
+from utils.job_queue import JobQueue
 from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
-                            reshape_adj_channels_to_complex_vals
-
-dtype = torch.cuda.FloatTensor
+                            reshape_adj_channels_to_complex_vals, \
+                            get_coil_compression, coil_compress
+from utils.device import set_device
 
 TEST_SET = ['005', '006', '030', '034', '048', '052', '065', '066', '080', 
             '096', '099', '120', '144', '156', '158', '173', '176', '178', 
@@ -23,67 +26,119 @@ ACCEL_LIST = [4, 8]
 
 def run_expmt(args):
 
-    for file_id in args.file_id_list: 
-
-        ksp_orig = load_qdess(file_id, idx_kx=None) # default central slice in kx (axial)
-
-        for accel in args.accel_list:
-
-            # manage paths for input/output
-            path_base = '/bmrNAS/people/dvv/out_qdess/accel_{}x/'.format(accel)
-            path_out = '{}{}/'.format(path_base, args.dir_out)
-            args.path_gt = path_base + 'gt/'
-            if os.path.exists('{}MTR_{}_e1.npy'.format(path_out, file_id)):
-                continue
-            if not os.path.exists(path_out):
-                os.makedirs(path_out)
-            if not os.path.exists(args.path_gt):
-                os.makedirs(args.path_gt)
-
-            # initialize network
-            net, net_input, ksp_orig_ = init_convdecoder(ksp_orig) 
-
-            # apply mask after rescaling k-space. want complex tensors dim (nc, ky, kz)
-            ksp_masked, mask = apply_mask(ksp_orig_, accel)#, calib=args.calib, expmt=True)
-            
-            # fit network, get net output - default 10k iterations, lam_tv=1e-8
-            net = fit(ksp_masked=ksp_masked, net=net, net_input=net_input, 
-                      mask=mask, num_iter=args.num_iter)
-            im_out = net(net_input.type(dtype)) # real tensor dim (2*nc, kx, ky)
-            im_out = reshape_adj_channels_to_complex_vals(im_out[0]) # complex tensor dim (nc, kx, ky)
-            
-            # perform dc step
-            ksp_est = fft_2d(im_out)
-            ksp_dc = torch.where(mask, ksp_masked, ksp_est)
-            #np.save('{}/MTR_{}_ksp_dc.npy'.format(path_out, file_id), ksp_dc.detach().numpy())
-
-            # create data-consistent, ground-truth images from k-space
-            im_1_dc = root_sum_squares(ifft_2d(ksp_dc[:8])).detach()
-            im_2_dc = root_sum_squares(ifft_2d(ksp_dc[8:])).detach()
-            np.save('{}MTR_{}_e1.npy'.format(path_out, file_id), im_1_dc)
-            np.save('{}MTR_{}_e2.npy'.format(path_out, file_id), im_2_dc)
-           
-            # save gt w proper array scaling if dne
-            if not os.path.exists('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id)):
-                im_1_gt = root_sum_squares(ifft_2d(ksp_orig[:8]))
-                im_2_gt = root_sum_squares(ifft_2d(ksp_orig[8:]))
-                np.save('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id), im_1_gt)
-                np.save('{}MTR_{}_e2_gt.npy'.format(args.path_gt, file_id), im_2_gt)
-            
-            print('recon {}'.format(file_id)) 
+    # on SIGTERM, exit s.t. the queue releases the job. see include.checkpoint
+    get_preemption().install()
+
+    # claim (file_id, accel) jobs from a queue shared w any concurrent workers
+    queue = JobQueue(args.queue, lease=args.lease)
+    queue.add([{'expmt': 'run_qdess', 'file_id': file_id, 'accel': accel,
+                'config': args.dir_out} for file_id in args.file_id_list \
+                                        for accel in args.accel_list],
+              is_done=lambda job: os.path.exists(get_file_done(args, job['file_id'],
+                                                               job['accel'])))
+    queue.run(lambda job: run_job(args, job['file_id'], job['accel']))
+    print('queue {}: {}'.format(args.queue, queue.summary()))
 
     return
 
+def run_job(args, file_id, accel):
+
+    # manage paths for input/output
+    path_base = '/bmrNAS/people/dvv/out_qdess/accel_{}x/'.format(accel)
+    path_out = '{}{}/'.format(path_base, args.dir_out)
+    args.path_gt = path_base + 'gt/'
+    if os.path.exists(get_file_done(args, file_id, accel)):
+        return
+    if not os.path.exists(path_out):
+        os.makedirs(path_out)
+    if not os.path.exists(args.path_gt):
+        os.makedirs(args.path_gt)
+
+    ksp_orig = load_qdess(file_id, idx_kx=None) # default central slice in kx (axial)
+
+    # optionally compress coils of each echo, w svd of the measured samples only
+    ksp_fit = ksp_orig
+    if args.num_vcoils or args.cc_energy:
+        cc_mat = get_coil_compression(ksp_orig * apply_mask(ksp_orig, accel)[1],
+                                      args.num_vcoils, args.cc_energy, num_groups=2)
+        ksp_fit = coil_compress(ksp_orig, cc_mat)
+
+    # initialize network
+    net, net_input, ksp_orig_ = init_convdecoder(ksp_fit, dtype=args.dtype)
+
+    # apply mask after rescaling k-space. want complex tensors dim (nc, ky, kz)
+    ksp_masked, mask = apply_mask(ksp_orig_, accel)#, calib=args.calib, expmt=True)
+    
+    # checkpoint per job, s.t. a preempted + requeued job resumes its fit
+    ckpt_file = None
+    if args.ckpt_dir:
+        os.makedirs(args.ckpt_dir, exist_ok=True)
+        ckpt_file = '{}/MTR_{}_{}x_{}.pt'.format(args.ckpt_dir, file_id, accel,
+                                                args.dir_out.replace('/', '_'))
+
+    # fit network, get net output - default 10k iterations, lam_tv=1e-8
+    net, info = fit(ksp_masked=ksp_masked, net=net, net_input=net_input, 
+                    mask=mask, num_iter=args.num_iter, dtype=args.dtype,
+                    snapshot_every=args.snapshot_every, 
+                    snapshot_start=args.snapshot_start,
+                    stop_criteria=get_stop_criteria(args.patience, args.min_delta,
+                                                    args.tol_resid, args.max_time),
+                    return_info=True, ckpt_file=ckpt_file, ckpt_every=args.ckpt_every)
+    im_out = net(net_input.type(args.dtype)) # real tensor dim (2*nc, kx, ky)
+    im_out = reshape_adj_channels_to_complex_vals(im_out[0]).cpu() # complex tensor dim (nc, kx, ky)
+    
+    # perform dc step
+    ksp_est = fft_2d(im_out)
+    ksp_dc = torch.where(mask, ksp_masked, ksp_est)
+    #np.save('{}/MTR_{}_ksp_dc.npy'.format(path_out, file_id), ksp_dc.detach().numpy())
+
+    # create data-consistent, ground-truth images from k-space
+    # rss over (virtual) coils of each echo, i.e. [echo1 | echo2] halves of ksp_dc
+    # save atomically, e1 last b/c its existence marks the job as done
+    nc = ksp_dc.shape[0] // 2
+    im_1_dc = root_sum_squares(ifft_2d(ksp_dc[:nc])).detach()
+    im_2_dc = root_sum_squares(ifft_2d(ksp_dc[nc:])).detach()
+    save_npy_atomic('{}MTR_{}_e2.npy'.format(path_out, file_id), im_2_dc)
+    save_npy_atomic('{}MTR_{}_e1.npy'.format(path_out, file_id), im_1_dc)
+   
+    # save gt w proper array scaling if dne
+    if not os.path.exists('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id)):
+        im_1_gt = root_sum_squares(ifft_2d(ksp_orig[:8]))
+        im_2_gt = root_sum_squares(ifft_2d(ksp_orig[8:]))
+        save_npy_atomic('{}MTR_{}_e2_gt.npy'.format(args.path_gt, file_id), im_2_gt)
+        save_npy_atomic('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id), im_1_gt)
+    
+    print('recon {}, {} iters, stop {}'.format(file_id, info['num_iter'],
+                                               info['stop_reason']))
+
+def get_file_done(args, file_id, accel):
+    ''' recon saved last by run_job(), s.t. its existence marks the job as done '''
+    return '/bmrNAS/people/dvv/out_qdess/accel_{}x/{}/MTR_{}_e1.npy'.format(
+                                                        accel, args.dir_out, file_id)
+
 def init_parser():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--gpu_id', type=int, default=2)
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
     parser.add_argument('--accel_list', nargs='+', type=int, default=ACCEL_LIST)
     parser.add_argument('--file_id_list', nargs='+', default=TEST_SET)
     parser.add_argument('--dir_out', type=str, default='')
+    parser.add_argument('--queue', type=str, required=True) # job manifest shared b/w workers, on a fs w posix locks
+    parser.add_argument('--lease', type=float, default=600) # reclaim jobs of dead workers after N sec w/o renewal
     parser.add_argument('--num_iter', type=int, default=10000)
+    parser.add_argument('--patience', type=int, default=None) # stop if loss plateaus for N iters
+    parser.add_argument('--min_delta', type=float, default=1e-3) # ... w relative tolerance
+    parser.add_argument('--tol_resid', type=float, default=None) # stop if rel ksp residual below
+    parser.add_argument('--max_time', type=float, default=None) # stop after N seconds per fit
     parser.add_argument('--calib', type=int, default=64)
+    parser.add_argument('--num_vcoils', type=int, default=None) # virtual coils per echo
+    parser.add_argument('--cc_energy', type=float, default=None) # ... or keep this energy, e.g. 0.95
+    parser.add_argument('--snapshot_every', type=int, default=1) # check for best net every N iters
+    parser.add_argument('--snapshot_start', type=int, default=0) # ... from this iter on
+    parser.add_argument('--ckpt_dir', type=str, default=None) # checkpoint fits here, resume if preempted
+    parser.add_argument('--ckpt_every', type=int, default=500) # ... every N iters + on SIGTERM
    
     # example of true/false arg
     #parser.add_argument('--_mask', dest='_mask', action='store_true')
@@ -97,6 +152,6 @@ def init_parser():
 if __name__ == '__main__':
     
     args = init_parser()
-    #torch.cuda.set_device(args.gpu_id)
+    args.dtype = set_device(args.device, args.num_threads)
 
     run_expmt(args)
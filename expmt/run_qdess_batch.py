@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+''' batched version of run_qdess.py: fit one convdecoder per slice, with
+    batch_size slices optimized together in a single forward/backward pass '''
+
+import os, sys
+import copy
+import time
+import numpy as np
+import torch
+import argparse
+
+from include.decoder_conv import init_convdecoder
+from include.fit import fit, fit_batch
+from include.mri_helpers import apply_mask
+from utils.data_io import load_qdess, get_slice_name
+from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
+                            reshape_adj_channels_to_complex_vals
+from utils.device import set_device
+
+TEST_SET = ['005', '006', '030', '034', '048', '052', '065', '066', '080',
+            '096', '099', '120', '144', '156', '158', '173', '176', '178',
+            '188', '196', '198', '199', '218', '219', '221', '223',
+            '224', '227', '235', '237', '240', '241', '244', '248']
+ACCEL_LIST = [4, 8]
+
+
+def run_expmt(args):
+
+    # list of (file_id, idx_kx) slices to recon. idx_kx=None is central slice
+    idx_kx_list = args.idx_kx_list if args.idx_kx_list else [None]
+    slice_list = [(f, i) for f in args.file_id_list for i in idx_kx_list]
+
+    for accel in args.accel_list:
+
+        # manage paths for input/output
+        path_base = '/bmrNAS/people/dvv/out_qdess/accel_{}x/'.format(accel)
+        path_out = '{}{}/'.format(path_base, args.dir_out)
+        args.path_gt = path_base + 'gt/'
+        if not os.path.exists(path_out):
+            os.makedirs(path_out)
+        if not os.path.exists(args.path_gt):
+            os.makedirs(args.path_gt)
+
+        todo = [s for s in slice_list if not os.path.exists( \
+                        '{}{}_e1.npy'.format(path_out, get_slice_name(*s)))]
+
+        for idx_b in range(0, len(todo), args.batch_size):
+
+            batch = todo[idx_b:idx_b+args.batch_size]
+
+            ksp_orig_list, ksp_masked_list, mask_list = [], [], []
+            net_list, net_input_list = [], []
+            for file_id, idx_kx in batch:
+                ksp_orig = load_qdess(file_id, idx_kx=idx_kx)
+                net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, dtype=args.dtype)
+                ksp_masked, mask = apply_mask(ksp_orig_, accel)
+
+                ksp_orig_list.append(ksp_orig)
+                ksp_masked_list.append(ksp_masked)
+                mask_list.append(mask)
+                net_list.append(net)
+                net_input_list.append(net_input)
+
+            if args.compare_serial: # reference timing: one fit() call per slice
+                t0 = time.time()
+                for idx in range(len(batch)):
+                    fit(ksp_masked=ksp_masked_list[idx], net=copy.deepcopy(net_list[idx]),
+                        net_input=net_input_list[idx], mask=mask_list[idx],
+                        num_iter=args.num_iter, dtype=args.dtype)
+                t_serial = time.time() - t0
+
+            # fit networks, get net outputs - default 10k iterations, lam_tv=1e-8
+            t0 = time.time()
+            net_list = fit_batch(ksp_masked_list, net_list, net_input_list, mask_list,
+                                 num_iter=args.num_iter, dtype=args.dtype)
+            t_batch = time.time() - t0
+
+            print('batch of {} slices: {:.1f} slices/hour'.format(
+                        len(batch), get_slices_per_hour(len(batch), t_batch)))
+            if args.compare_serial:
+                print('serial loop: {:.1f} slices/hour'.format(
+                        get_slices_per_hour(len(batch), t_serial)))
+
+            for idx, (file_id, idx_kx) in enumerate(batch):
+                save_recon(net_list[idx], net_input_list[idx], ksp_masked_list[idx],
+                           mask_list[idx], ksp_orig_list[idx],
+                           get_slice_name(file_id, idx_kx), path_out, args)
+                print('recon {}'.format(get_slice_name(file_id, idx_kx)))
+
+    return
+
+def save_recon(net, net_input, ksp_masked, mask, ksp_orig, name, path_out, args):
+    ''' perform dc step on net output, save dc + gt images '''
+
+    im_out = net(net_input.type(args.dtype)) # real tensor dim (2*nc, kx, ky)
+    im_out = reshape_adj_channels_to_complex_vals(im_out[0]).cpu() # complex tensor dim (nc, kx, ky)
+
+    # perform dc step
+    ksp_est = fft_2d(im_out)
+    ksp_dc = torch.where(mask, ksp_masked, ksp_est)
+
+    # create data-consistent, ground-truth images from k-space
+    im_1_dc = root_sum_squares(ifft_2d(ksp_dc[:8])).detach()
+    im_2_dc = root_sum_squares(ifft_2d(ksp_dc[8:])).detach()
+    np.save('{}{}_e1.npy'.format(path_out, name), im_1_dc)
+    np.save('{}{}_e2.npy'.format(path_out, name), im_2_dc)
+
+    # save gt w proper array scaling if dne
+    if not os.path.exists('{}{}_e1_gt.npy'.format(args.path_gt, name)):
+        im_1_gt = root_sum_squares(ifft_2d(ksp_orig[:8]))
+        im_2_gt = root_sum_squares(ifft_2d(ksp_orig[8:]))
+        np.save('{}{}_e1_gt.npy'.format(args.path_gt, name), im_1_gt)
+        np.save('{}{}_e2_gt.npy'.format(args.path_gt, name), im_2_gt)
+
+def get_slices_per_hour(num_slices, seconds):
+    return 3600. * num_slices / seconds
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--accel_list', nargs='+', type=int, default=ACCEL_LIST)
+    parser.add_argument('--file_id_list', nargs='+', default=TEST_SET)
+    parser.add_argument('--idx_kx_list', nargs='+', type=int, default=None)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--dir_out', type=str, default='')
+    parser.add_argument('--num_iter', type=int, default=10000)
+    parser.add_argument('--compare_serial', dest='compare_serial', action='store_true')
+    parser.set_defaults(compare_serial=False)
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+
+    args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
+
+    run_expmt(args)
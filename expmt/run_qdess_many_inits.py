@@ -7,12 +7,14 @@ import argparse
 
 from include.decoder_conv import init_convdecoder
 from include.fit import fit
+from include.stopping import get_stop_criteria
 from include.mri_helpers import apply_mask
-from utils.data_io import load_qdess
+from include.checkpoint import get_preemption
+from utils.data_io import load_qdess, save_npy_atomic
+from utils.job_queue import JobQueue
 from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
                             reshape_adj_channels_to_complex_vals
-
-dtype = torch.cuda.FloatTensor
+from utils.device import set_device
 
 TEST_SET = ['005', '006', '030', '034', '048', '052', '065', '066', '080', 
             '096', '099', '120']
@@ -22,75 +24,132 @@ NUM_INITS = 4
 
 def run_expmt(args):
 
-    for file_id in args.file_id_list: 
-
-        ksp_orig = load_qdess(file_id, idx_kx=None) # default central slice in kx (axial)
-
-        for accel in args.accel_list:
-
-            # manage paths for input/output
-            path_base = '/bmrNAS/people/dvv/out_qdess/accel_{}x/'.format(accel)
-            path_out = '{}{}/'.format(path_base, args.dir_out)
-            args.path_gt = path_base + 'gt/'
-            
-            for idx_init in np.arange(NUM_INITS): 
-
-                if os.path.exists('{}MTR_{}_e1_init{}.npy'.format(path_out, file_id, idx_init)):
-                    continue
-                if not os.path.exists(path_out):
-                    os.makedirs(path_out)
-                if not os.path.exists(args.path_gt):
-                    os.makedirs(args.path_gt)
-
-                # initialize network 
-                net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, fix_random_seed=False) 
-
-                # apply mask after rescaling k-space. want complex tensors dim (nc, ky, kz)
-                ksp_masked, mask = apply_mask(ksp_orig_, accel, calib=args.calib, expmt=True)
-
-                # fit network, get net output - default 10k iterations, lam_tv=1e-8
-                net = fit(ksp_masked, net, net_input, mask, num_iter=args.num_iter)
-                im_out = net(net_input.type(dtype)) # real tensor dim (2*nc, kx, ky)
-                im_out = reshape_adj_channels_to_complex_vals(im_out[0]) # complex tensor dim (nc, kx, ky)
-                # perform dc step
-                ksp_est = fft_2d(im_out)
-                ksp_dc = torch.where(mask, ksp_masked, ksp_est)
-                np.save('{}/MTR_{}_ksp_dc.npy'.format(path_out, file_id), ksp_dc.detach().numpy())
-
-                # create data-consistent, ground-truth images from k-space
-                im_1_dc = root_sum_squares(ifft_2d(ksp_dc[:8])).detach()
-                im_2_dc = root_sum_squares(ifft_2d(ksp_dc[8:])).detach()
-                np.save('{}MTR_{}_e1_init{}.npy'.format(path_out, file_id, idx_init), im_1_dc)
-                np.save('{}MTR_{}_e2_init{}.npy'.format(path_out, file_id, idx_init), im_2_dc)
-               
-                # save gt w proper array scaling if dne
-                if not os.path.exists('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id)):
-                    im_1_gt = root_sum_squares(ifft_2d(ksp_orig[:8]))
-                    im_2_gt = root_sum_squares(ifft_2d(ksp_orig[8:]))
-                    np.save('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id), im_1_gt)
-                    np.save('{}MTR_{}_e2_gt.npy'.format(args.path_gt, file_id), im_2_gt)
-                
-                print('recon {}'.format(file_id)) 
+    # on SIGTERM, exit s.t. the queue releases the job. see include.checkpoint
+    get_preemption().install()
+
+    # claim (file_id, accel, init) jobs from a queue shared w any concurrent workers
+    queue = JobQueue(args.queue, lease=args.lease)
+    queue.add([{'expmt': 'run_qdess_many_inits', 'file_id': file_id, 'accel': accel,
+                'idx_init': idx_init, 'config': args.dir_out} \
+                for file_id in args.file_id_list for accel in args.accel_list \
+                for idx_init in range(NUM_INITS)],
+              is_done=lambda job: os.path.exists(get_file_done(args, job['file_id'],
+                                                      job['accel'], job['idx_init'])))
+    queue.run(lambda job: run_job(args, job['file_id'], job['accel'], job['idx_init']))
+    print('queue {}: {}'.format(args.queue, queue.summary()))
+
+    return
+
+def run_job(args, file_id, accel, idx_init):
+
+    # manage paths for input/output
+    path_base = '/bmrNAS/people/dvv/out_qdess/accel_{}x/'.format(accel)
+    path_out = '{}{}/'.format(path_base, args.dir_out)
+    args.path_gt = path_base + 'gt/'
 
+    if os.path.exists(get_file_done(args, file_id, accel, idx_init)):
         return
+    if not os.path.exists(path_out):
+        os.makedirs(path_out)
+    if not os.path.exists(args.path_gt):
+        os.makedirs(args.path_gt)
+
+    ksp_orig = load_qdess(file_id, idx_kx=None) # default central slice in kx (axial)
+
+    # checkpoint per job, s.t. a preempted + requeued job resumes its fit
+    # seed init per job, s.t. the resumed fit has the same net input + ksp scaling
+    ckpt_file = None
+    if args.ckpt_dir:
+        os.makedirs(args.ckpt_dir, exist_ok=True)
+        ckpt_file = '{}/MTR_{}_{}x_init{}_{}.pt'.format(args.ckpt_dir, file_id, accel,
+                                            idx_init, args.dir_out.replace('/', '_'))
+        torch.manual_seed(get_init_seed(args, file_id, accel, idx_init))
+
+    # initialize network 
+    net, net_input, ksp_orig_ = init_convdecoder(ksp_orig, fix_random_seed=False,
+                                            dtype=args.dtype)
+
+    # apply mask after rescaling k-space. want complex tensors dim (nc, ky, kz)
+    ksp_masked, mask = apply_mask(ksp_orig_, accel, calib=args.calib, expmt=True,
+                                  seed=get_mask_seed(args, file_id, accel, idx_init))
+
+    # fit network, get net output - default 10k iterations, lam_tv=1e-8
+    net, info = fit(ksp_masked, net, net_input, mask, num_iter=args.num_iter,
+                    dtype=args.dtype, return_info=True,
+                    stop_criteria=get_stop_criteria(args.patience, args.min_delta,
+                                                    args.tol_resid, args.max_time),
+                    ckpt_file=ckpt_file, ckpt_every=args.ckpt_every)
+    im_out = net(net_input.type(args.dtype)) # real tensor dim (2*nc, kx, ky)
+    im_out = reshape_adj_channels_to_complex_vals(im_out[0]).cpu() # complex tensor dim (nc, kx, ky)
+    # perform dc step
+    ksp_est = fft_2d(im_out)
+    ksp_dc = torch.where(mask, ksp_masked, ksp_est)
+    save_npy_atomic('{}MTR_{}_ksp_dc_init{}.npy'.format(path_out, file_id, idx_init),
+                    ksp_dc.detach().numpy())
+
+    # create data-consistent, ground-truth images from k-space
+    # save atomically, e1 last b/c its existence marks the job as done
+    im_1_dc = root_sum_squares(ifft_2d(ksp_dc[:8])).detach()
+    im_2_dc = root_sum_squares(ifft_2d(ksp_dc[8:])).detach()
+    save_npy_atomic('{}MTR_{}_e2_init{}.npy'.format(path_out, file_id, idx_init), im_2_dc)
+    save_npy_atomic('{}MTR_{}_e1_init{}.npy'.format(path_out, file_id, idx_init), im_1_dc)
+   
+    # save gt w proper array scaling if dne
+    if not os.path.exists('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id)):
+        im_1_gt = root_sum_squares(ifft_2d(ksp_orig[:8]))
+        im_2_gt = root_sum_squares(ifft_2d(ksp_orig[8:]))
+        save_npy_atomic('{}MTR_{}_e2_gt.npy'.format(args.path_gt, file_id), im_2_gt)
+        save_npy_atomic('{}MTR_{}_e1_gt.npy'.format(args.path_gt, file_id), im_1_gt)
+    
+    print('recon {}, {} iters, stop {}'.format(file_id, info['num_iter'],
+                                               info['stop_reason']))
+
+def get_file_done(args, file_id, accel, idx_init):
+    ''' recon saved last by run_job(), s.t. its existence marks the job as done '''
+    return '/bmrNAS/people/dvv/out_qdess/accel_{}x/{}/MTR_{}_e1_init{}.npy'.format(
+                                            accel, args.dir_out, file_id, idx_init)
+
+def get_mask_seed(args, file_id, *idx):
+    ''' per-job seed for choosing a random mask variant, s.t. runs can be replayed '''
+    if args.mask_seed is None:
+        return None
+    return [args.mask_seed, int(file_id), *[int(i) for i in idx]]
+
+def get_init_seed(args, file_id, *idx):
+    ''' per-job torch seed for network init, derived from the mask seed '''
+    seq = np.random.SeedSequence(get_mask_seed(args, file_id, *idx))
+    return int(seq.generate_state(1)[0])
 
 def init_parser():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--gpu_id', type=int, default=2)
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
     parser.add_argument('--accel_list', nargs='+', type=int, default=ACCEL_LIST)
     parser.add_argument('--file_id_list', nargs='+', default=TEST_SET)
     parser.add_argument('--dir_out', type=str, default='')
+    parser.add_argument('--queue', type=str, required=True) # job manifest shared b/w workers, on a fs w posix locks
+    parser.add_argument('--lease', type=float, default=600) # reclaim jobs of dead workers after N sec w/o renewal
     parser.add_argument('--num_iter', type=int, default=10000)
+    parser.add_argument('--patience', type=int, default=None) # stop if loss plateaus for N iters
+    parser.add_argument('--min_delta', type=float, default=1e-3) # ... w relative tolerance
+    parser.add_argument('--tol_resid', type=float, default=None) # stop if rel ksp residual below
+    parser.add_argument('--max_time', type=float, default=None) # stop after N seconds per fit
     parser.add_argument('--calib', type=int, default=64)
+    parser.add_argument('--mask_seed', type=int, default=None) # seed for mask choice. default random
+    parser.add_argument('--ckpt_dir', type=str, default=None) # checkpoint fits here, resume if preempted
+    parser.add_argument('--ckpt_every', type=int, default=500) # ... every N iters + on SIGTERM
     
     args = parser.parse_args()
+    if args.ckpt_dir and args.mask_seed is None: # resumed fit needs same init + mask
+        parser.error('--ckpt_dir requires --mask_seed')
 
     return args
 
 if __name__ == '__main__':
     
     args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
 
     run_expmt(args)
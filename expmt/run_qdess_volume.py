@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+''' volume version of run_qdess.py: fit a range of kx slices per file, sweeping
+    outward from the central slice w each slice warm started from its neighbor '''
+
+import os, sys
+import time
+import numpy as np
+import torch
+import argparse
+
+from include.volume import fit_volume
+from include.stopping import get_stop_criteria
+from include.mri_helpers import apply_mask
+from utils.data_io import load_qdess, get_qdess_shape, get_slice_name
+from utils.evaluate import psnr, ssim
+from utils.transform import fft_2d, ifft_2d, root_sum_squares, \
+                            reshape_adj_channels_to_complex_vals
+from utils.device import set_device
+
+TEST_SET = ['005', '006', '030', '034', '048', '052', '065', '066', '080',
+            '096', '099', '120', '144', '156', '158', '173', '176', '178',
+            '188', '196', '198', '199', '218', '219', '221', '223',
+            '224', '227', '235', '237', '240', '241', '244', '248']
+ACCEL_LIST = [4, 8]
+
+
+def run_expmt(args):
+
+    for file_id in args.file_id_list:
+
+        # read each slice on demand from cache, or from h5 rather than the full volume
+        get_ksp = lambda idx_kx: load_qdess(file_id, idx_kx)
+
+        idx_center = get_qdess_shape(file_id)[0] // 2
+        idx_list = range(idx_center - args.num_slices // 2,
+                         idx_center + (args.num_slices + 1) // 2)
+
+        for accel in args.accel_list:
+
+            # manage paths for input/output
+            path_base = '/bmrNAS/people/dvv/out_qdess/accel_{}x/'.format(accel)
+            path_out = '{}{}/'.format(path_base, args.dir_out)
+            args.path_gt = path_base + 'gt/'
+            if not os.path.exists(path_out):
+                os.makedirs(path_out)
+            if not os.path.exists(args.path_gt):
+                os.makedirs(args.path_gt)
+
+            _, mask = apply_mask(get_ksp(idx_center), accel)
+
+            recons, iters = {}, {}
+            for warm_start in [True, False] if args.compare_cold else [True]:
+
+                t0 = time.time()
+                for idx_kx, net, net_input, ksp_masked, ksp_orig_, info in fit_volume(
+                        get_ksp, idx_list, mask, idx_center=idx_center,
+                        num_iter=args.num_iter, num_iter_warm=args.num_iter_warm,
+                        warm_start=warm_start, warm_optimizer=args.warm_optimizer,
+                        dtype=args.dtype, stop_criteria=get_stop_criteria(
+                            args.patience, args.min_delta, args.tol_resid, args.max_time)):
+
+                    im_dc = get_dc_imgs(net, net_input, ksp_masked, mask, args)
+                    recons[warm_start, idx_kx] = im_dc
+                    iters[warm_start, idx_kx] = info['num_iter']
+                    if warm_start: # save warm start recons only
+                        name = get_slice_name(file_id, idx_kx)
+                        save_imgs(im_dc, get_gt_imgs(get_ksp(idx_kx)), name, path_out, args)
+                        print('recon {}, {} iters, warm start {}'.format(
+                                    name, info['num_iter'], info['warm_start']))
+
+                print('{} {}x, {} slices: {:.1f}s, {} iters total ({})'.format(
+                            file_id, accel, len(idx_list), time.time() - t0,
+                            sum(iters[warm_start, i] for i in idx_list),
+                            'warm' if warm_start else 'cold'))
+
+            if args.compare_cold:
+                print_comparison(recons, iters, idx_list, get_ksp, mask)
+
+    return
+
+def get_dc_imgs(net, net_input, ksp_masked, mask, args):
+    ''' perform dc step on net output, return rss imgs of echo1, echo2 '''
+
+    im_out = net(net_input.type(args.dtype)) # real tensor dim (2*nc, kx, ky)
+    im_out = reshape_adj_channels_to_complex_vals(im_out[0]).cpu() # complex tensor dim (nc, kx, ky)
+
+    # perform dc step
+    ksp_est = fft_2d(im_out)
+    ksp_dc = torch.where(mask, ksp_masked, ksp_est)
+
+    im_1_dc = root_sum_squares(ifft_2d(ksp_dc[:8])).detach()
+    im_2_dc = root_sum_squares(ifft_2d(ksp_dc[8:])).detach()
+
+    return im_1_dc, im_2_dc
+
+def get_gt_imgs(ksp_orig):
+    ''' return rss imgs of echo1, echo2 from fully sampled k-space '''
+    return root_sum_squares(ifft_2d(ksp_orig[:8])), \
+           root_sum_squares(ifft_2d(ksp_orig[8:]))
+
+def save_imgs(im_dc, im_gt, name, path_out, args):
+    ''' save dc imgs, and gt w proper array scaling if dne '''
+
+    np.save('{}{}_e1.npy'.format(path_out, name), im_dc[0])
+    np.save('{}{}_e2.npy'.format(path_out, name), im_dc[1])
+
+    if not os.path.exists('{}{}_e1_gt.npy'.format(args.path_gt, name)):
+        np.save('{}{}_e1_gt.npy'.format(args.path_gt, name), im_gt[0])
+        np.save('{}{}_e2_gt.npy'.format(args.path_gt, name), im_gt[1])
+
+def print_comparison(recons, iters, idx_list, get_ksp, mask):
+    ''' report iteration savings + quality difference of warm v cold starts
+        metrics on echo1 + echo2, each w.r.t. gt of the unscaled slice '''
+
+    iters_warm = sum(iters[True, i] for i in idx_list)
+    iters_cold = sum(iters[False, i] for i in idx_list)
+    print('iters warm {}, cold {}: {:.1f}x fewer'.format(
+                        iters_warm, iters_cold, iters_cold / iters_warm))
+
+    d_psnr, d_ssim = [], []
+    for idx_kx in idx_list:
+        im_gt = get_gt_imgs(get_ksp(idx_kx))
+        for e in range(2):
+            gt = np.array(im_gt[e])
+            gt_max = gt.max()
+            warm = np.array(recons[True, idx_kx][e])
+            cold = np.array(recons[False, idx_kx][e])
+            # recons are in scaled units, so match max intensity to gt
+            warm, cold = warm * gt_max / warm.max(), cold * gt_max / cold.max()
+            d_psnr.append(psnr(gt, warm) - psnr(gt, cold))
+            d_ssim.append(ssim(gt, warm) - ssim(gt, cold))
+
+    print('warm - cold: psnr {:+.3f} (min {:+.3f}), ssim {:+.4f} (min {:+.4f})'.format(
+                np.mean(d_psnr), np.min(d_psnr), np.mean(d_ssim), np.min(d_ssim)))
+
+def init_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--device', type=str, default=None) # e.g. cpu, cuda:2. default gpu if available
+    parser.add_argument('--num_threads', type=int, default=None) # cpu threads. default all cores
+    parser.add_argument('--accel_list', nargs='+', type=int, default=ACCEL_LIST)
+    parser.add_argument('--file_id_list', nargs='+', default=TEST_SET)
+    parser.add_argument('--num_slices', type=int, default=9) # kx slices centered on central slice
+    parser.add_argument('--dir_out', type=str, default='')
+    parser.add_argument('--num_iter', type=int, default=10000) # iters for central slice
+    parser.add_argument('--num_iter_warm', type=int, default=1000) # iters for warm started slices
+    parser.add_argument('--warm_optimizer', dest='warm_optimizer', action='store_true')
+    parser.add_argument('--compare_cold', dest='compare_cold', action='store_true')
+    parser.set_defaults(warm_optimizer=False, compare_cold=False)
+    parser.add_argument('--patience', type=int, default=None) # stop if loss plateaus for N iters
+    parser.add_argument('--min_delta', type=float, default=1e-3) # ... w relative tolerance
+    parser.add_argument('--tol_resid', type=float, default=None) # stop if rel ksp residual below
+    parser.add_argument('--max_time', type=float, default=None) # stop after N seconds per fit
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+
+    args = init_parser()
+    args.dtype = set_device(args.device, args.num_threads)
+
+    run_expmt(args)
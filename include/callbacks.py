@@ -0,0 +1,177 @@
+''' opt-in instrumentation of fit(), e.g. fit(..., callbacks=[LossHistory(), PhaseTimes()])
+
+    each callback may implement
+        on_fit_start(num_iter): before the first iteration
+        on_iter_start(i): before iteration i
+        on_iter_end(i, logs): after iteration i w logs dict of
+            loss: total loss
+            loss_img: mse term of the loss in img space, i.e. w.r.t. masked k-space
+            resid: relative k-space residual ||M*F(out) - y|| / ||y||
+            times: dict phase --> seconds, only if a callback sets timing = True
+            mem_peak: peak memory in bytes, ditto
+        on_fit_end(info): w the info dict fit() returns if return_info
+    callbacks add a host sync per iteration, so leave them off for production runs '''
+
+import time
+import resource
+import contextlib
+import numpy as np
+import torch
+
+# phases of a fit() iteration timed by PhaseTimer
+# w a compiled step, forward covers forward, forwardm, loss, as they're one graph
+PHASES = ['forward', 'forwardm', 'loss', 'backward', 'step', 'snapshot', 'checkpoint']
+
+
+class Callback():
+    ''' base class for fit() callbacks '''
+
+    timing = False # if True, fit() times each phase of an iteration
+
+    def on_fit_start(self, num_iter):
+        pass
+
+    def on_iter_start(self, i):
+        pass
+
+    def on_iter_end(self, i, logs):
+        pass
+
+    def on_fit_end(self, info):
+        pass
+
+class LossHistory(Callback):
+    ''' record loss, mse term, k-space residual at each iteration '''
+
+    def on_fit_start(self, num_iter):
+        self.iters, self.loss, self.loss_img, self.resid = [], [], [], []
+
+    def on_iter_end(self, i, logs):
+        self.iters.append(i)
+        self.loss.append(logs['loss'])
+        self.loss_img.append(logs['loss_img'])
+        self.resid.append(logs['resid'])
+
+    def as_arrays(self):
+        ''' return dict name --> np array [num_iter] '''
+        return {k: np.array(getattr(self, k)) for k in \
+                ['iters', 'loss', 'loss_img', 'resid']}
+
+class PhaseTimes(Callback):
+    ''' record time per phase + peak memory at each iteration '''
+
+    timing = True
+
+    def on_fit_start(self, num_iter):
+        self.times = {phase: [] for phase in PHASES}
+        self.mem_peak = []
+
+    def on_iter_end(self, i, logs):
+        for phase in PHASES:
+            self.times[phase].append(logs['times'].get(phase, 0.))
+        self.mem_peak.append(logs['mem_peak'])
+
+    def summary(self, skip=1):
+        ''' return dict phase --> mean seconds per iteration, plus peak memory
+            skip: num of initial iterations to exclude, e.g. warmup, compilation '''
+
+        summary = {phase: float(np.mean(t[skip:])) for phase, t in self.times.items() \
+                   if len(t) > skip}
+        summary['total'] = sum(summary.values())
+        summary['mem_peak'] = max(self.mem_peak) if self.mem_peak else 0
+
+        return summary
+
+    def print_summary(self, skip=1):
+        summary = self.summary(skip)
+        for phase in PHASES + ['total']:
+            if phase in summary:
+                print('{:>10}: {:.2f} ms/iter'.format(phase, 1e3 * summary[phase]))
+        print('{:>10}: {:.1f} MB'.format('mem_peak', summary['mem_peak'] / 2**20))
+
+class TorchProfile(Callback):
+    ''' export a torch.profiler trace of iterations [start, stop), viewable in
+        chrome://tracing or tensorboard. phases are labeled via record_function
+        requires torch >= 1.8.1 '''
+
+    timing = True # s.t. phases are labeled in the trace
+
+    def __init__(self, filename, start=10, stop=15):
+        self.filename = filename
+        self.start = start
+        self.stop = stop
+        self.prof = None
+
+    def on_iter_start(self, i):
+        if i == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, record_shapes=True,
+                                               profile_memory=True)
+            self.prof.__enter__()
+
+    def on_iter_end(self, i, logs):
+        if i == self.stop - 1:
+            self.export()
+
+    def on_fit_end(self, info):
+        self.export() # in case fit stopped early
+
+    def export(self):
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        self.prof.export_chrome_trace(self.filename)
+        self.prof = None
+
+class PhaseTimer():
+    ''' accumulate wall-clock time per phase, e.g. w timer('forward'): ...
+        time of nested phases is excluded from the enclosing phase. syncs cuda
+        at each boundary, s.t. async kernels are attributed to the right phase '''
+
+    def __init__(self, device):
+        self.cuda = device.type == 'cuda'
+        self.stack = [] # time spent in nested phases, per open phase
+        self.reset()
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        self.sync()
+        t0 = time.perf_counter()
+        self.stack.append(0.)
+        try:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        finally:
+            self.sync()
+            dt = time.perf_counter() - t0
+            self.times[name] = self.times.get(name, 0.) + dt - self.stack.pop()
+            if self.stack:
+                self.stack[-1] += dt
+
+    def reset(self):
+        ''' call at start of each iteration '''
+
+        self.times = {}
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def get_mem_peak(self):
+        ''' peak cuda memory allocated this iteration, or peak rss of process on cpu '''
+
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kB on linux
+
+class NullTimer():
+    ''' stand-in for PhaseTimer when fit() isn't timed '''
+
+    def __call__(self, name):
+        return contextlib.nullcontext()
+
+NULL_TIMER = NullTimer()
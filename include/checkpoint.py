@@ -0,0 +1,146 @@
+''' checkpoint + resume of fit(), s.t. a preempted job loses at most a few iterations
+
+    a checkpoint holds the current + best network weights, adam state, next
+    iteration, best loss, stopping criteria state, and rng state. it's written
+    atomically every N iterations, and on SIGTERM, e.g. sent by slurm before
+    preempting a job or hitting its time limit. see expmt/run.sh
+
+    SIGTERM is handled once per worker process by Preemption, see get_preemption()
+    within a fit, SystemExit is raised after the current iteration, once the
+    checkpoint is saved. elsewhere it's raised right away, s.t. e.g. a job queue
+    can release the job in either case '''
+
+import os
+import contextlib
+import signal
+import random
+import numpy as np
+import torch
+
+
+class FitCheckpoint():
+
+    def __init__(self, filename, every=500):
+        ''' filename: path of checkpoint file, one per fit, i.e. per job
+            every: save a checkpoint every N iterations '''
+
+        self.filename = filename
+        self.every = every
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def is_save_iter(self, i):
+        ''' i: iteration just completed '''
+        return get_preemption().requested or (i + 1) % self.every == 0
+
+    def save(self, i, net, best_net, best_mse, optimizer, stop_criteria, elapsed):
+        ''' i: next iteration to run on resume
+            best_net: NetSnapshot of best network so far
+            best_mse: float, or tensor [n] of per-sample losses for fit_batch()
+            elapsed: seconds of fitting so far '''
+
+        state = {'iter': i,
+                 'net': net.state_dict(),
+                 'best_net': best_net.state,
+                 'best_mse': torch.as_tensor(best_mse).tolist(),
+                 'optimizer': optimizer.state_dict(),
+                 'stop_criteria': [crit.state_dict() for crit in stop_criteria],
+                 'elapsed': elapsed,
+                 'rng': get_rng_state()}
+
+        # write to tmp file, then rename, s.t. a kill mid-write leaves the old file intact
+        path_tmp = '{}.tmp'.format(self.filename)
+        torch.save(state, path_tmp)
+        os.replace(path_tmp, self.filename)
+
+    def load(self, net, best_net, optimizer, stop_criteria):
+        ''' restore state in place. returns next iteration, best loss, elapsed seconds '''
+
+        state = torch.load(self.filename, map_location='cpu')
+
+        net.load_state_dict(state['net'])
+        for k, v in state['best_net'].items():
+            best_net.state[k].copy_(v)
+        optimizer.load_state_dict(state['optimizer'])
+        if len(state['stop_criteria']) != len(stop_criteria):
+            raise ValueError('checkpoint {} has {} stopping criteria, fit has {}'.format(
+                    self.filename, len(state['stop_criteria']), len(stop_criteria)))
+        for crit, crit_state in zip(stop_criteria, state['stop_criteria']):
+            crit.load_state_dict(crit_state)
+        set_rng_state(state['rng'])
+
+        return state['iter'], state['best_mse'], state['elapsed']
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.filename)
+
+class Preemption():
+    ''' SIGTERM handler, installed once per worker process. outside of deferred(),
+        SIGTERM raises SystemExit right away. inside, e.g. during a fit, it only
+        sets requested, s.t. the fit can save a checkpoint at the end of the
+        current iteration, then raise SystemExit itself '''
+
+    def __init__(self):
+        self.requested = False
+        self.num_deferred = 0
+        self.installed = False
+
+    def install(self):
+        ''' only possible from the main thread, else a no-op. returns if installed '''
+
+        if not self.installed:
+            try:
+                signal.signal(signal.SIGTERM, self.handle)
+                self.installed = True
+            except ValueError: # not main thread
+                pass
+
+        return self.installed
+
+    def handle(self, signum, frame):
+        self.requested = True
+        if self.num_deferred == 0:
+            raise SystemExit('preempted by signal {}'.format(signum))
+
+    @contextlib.contextmanager
+    def deferred(self):
+        ''' within context, SIGTERM only sets requested, s.t. the caller can raise
+            SystemExit at a safe point. if it didn't, raise on leaving the context '''
+
+        self.num_deferred += 1
+        try:
+            yield
+        finally:
+            self.num_deferred -= 1
+        if self.requested and self.num_deferred == 0:
+            raise SystemExit('preempted')
+
+_preemption = None
+
+def get_preemption():
+    ''' return process-wide Preemption, s.t. the SIGTERM handler is shared '''
+    global _preemption
+    if _preemption is None:
+        _preemption = Preemption()
+    return _preemption
+
+def get_rng_state():
+    # numpy state as builtin types, s.t. torch.load() w weights_only can read it
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(),
+             'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+             'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss,
+                         cached_gaussian))
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
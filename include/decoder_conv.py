@@ -5,8 +5,7 @@ from torch.autograd import Variable
 
 from utils.transform import reshape_adj_channels_to_complex_vals, \
                             root_sum_squares, ifft_2d
-
-dtype=torch.cuda.FloatTensor
+from utils.device import DEFAULT_DTYPE
 
 def add_module(self, module):
     self.add_module(str(len(self) + 1), module)
@@ -15,7 +14,11 @@ torch.nn.Module.add = add_module
 
 class Conv_Model(nn.Module):
     def __init__(self, num_layers, num_channels, out_depth, hidden_size, 
-                 upsample_mode='nearest', kernel_size=3, bias=False):
+                 upsample_mode='nearest', kernel_size=3, bias=False, num_groups=1):
+        ''' num_groups: number of independent decoders evaluated as one network
+                        via grouped convolutions, i.e. group g maps input channels
+                        [g*num_channels, (g+1)*num_channels) to output channels
+                        [g*out_depth, (g+1)*out_depth). see stack_convdecoders() '''
         super(Conv_Model, self).__init__()
 
         self.num_layers = num_layers
@@ -25,24 +28,28 @@ class Conv_Model(nn.Module):
         self.upsample_mode = upsample_mode
         self.kernel_size = 3
         self.bias = False
+        self.num_groups = num_groups
+
+        nch = num_channels * num_groups # total channels across all groups
 
         net = nn.Sequential()
         
         # first (num_layers-1) upsampling layers
         for i in range(num_layers-1):
             net.add(nn.Upsample(size=hidden_size[i], mode=upsample_mode))#,align_corners=True))
-            net.add(nn.Conv2d(in_channels=num_channels, out_channels=num_channels, 
-                             kernel_size=3, stride=1, padding=1, bias=bias))
+            net.add(nn.Conv2d(in_channels=nch, out_channels=nch, kernel_size=3, 
+                              stride=1, padding=1, bias=bias, groups=num_groups))
             net.add(nn.ReLU())
-            net.add(nn.BatchNorm2d(num_channels, affine=True))
+            net.add(nn.BatchNorm2d(nch, affine=True))
         
         # final layer: convert number of channels
-        net.add(nn.Conv2d(in_channels=num_channels, out_channels=num_channels, \
-                           kernel_size=3, stride=1, padding=1, bias=bias))
+        net.add(nn.Conv2d(in_channels=nch, out_channels=nch, kernel_size=3, \
+                          stride=1, padding=1, bias=bias, groups=num_groups))
         net.add(nn.ReLU())
-        net.add(nn.BatchNorm2d(num_channels, affine=True))
-        net.add(nn.Conv2d(in_channels=num_channels, out_channels=out_depth, \
-                           kernel_size=1, stride=1, padding=0, bias=bias))
+        net.add(nn.BatchNorm2d(nch, affine=True))
+        net.add(nn.Conv2d(in_channels=nch, out_channels=out_depth*num_groups, \
+                          kernel_size=1, stride=1, padding=0, bias=bias, 
+                          groups=num_groups))
         
         self.net = net
 
@@ -52,11 +59,12 @@ class Conv_Model(nn.Module):
 
 def init_convdecoder(ksp_orig, \
                      in_size=[8,4], num_layers=8, num_channels=160, kernel_size=3,
-                     fix_random_seed=True):
+                     fix_random_seed=True, dtype=DEFAULT_DTYPE):
     ''' wrapper function for initializing convdecoder based on input ksp_orig
 
         parameters:
                 ksp_orig: original, unmasked k-space measurements
+                dtype: tensor type, e.g. torch.FloatTensor to run on cpu
         return:
                 net: initialized convdecoder
                 net_input: random, scaled input seed
@@ -73,10 +81,10 @@ def init_convdecoder(ksp_orig, \
 
 #     print('# parameters of ConvDecoder:',num_params(net))
 
-    net_input = get_net_input(num_channels, in_size, fix_random_seed)
+    net_input = get_net_input(num_channels, in_size, fix_random_seed, dtype=dtype)
     
     # create scaled ksp to be compatible w network magnitude
-    scale_factor = get_scale_factor(net, net_input, ksp_orig)
+    scale_factor = get_scale_factor(net, net_input, ksp_orig, dtype=dtype)
     ksp_orig_ = ksp_orig * scale_factor
 
     return net, net_input, ksp_orig_
@@ -98,7 +106,7 @@ def get_hidden_size(in_size, out_size, num_layers):
 
     return hidden_size
 
-def get_net_input(num_channels, in_size, fix_random_seed=True):
+def get_net_input(num_channels, in_size, fix_random_seed=True, dtype=DEFAULT_DTYPE):
     ''' return net_input, e.g. tensor w values samples uniformly on [0,1] '''
     
     shape = [1, num_channels, in_size[0], in_size[1]]
@@ -109,7 +117,7 @@ def get_net_input(num_channels, in_size, fix_random_seed=True):
 
     return net_input
 
-def get_scale_factor(net, net_input, ksp_orig):
+def get_scale_factor(net, net_input, ksp_orig, dtype=DEFAULT_DTYPE):
     ''' return scaling factor, i.e. difference in magnitudes scaling b/w:
         original image and random image of network output = net(net_input) '''
 
@@ -126,6 +134,49 @@ def get_scale_factor(net, net_input, ksp_orig):
 
     return torch.linalg.norm(out_img) / torch.linalg.norm(orig_img)
 
+###### helper functions for evaluating many convdecoders as one network ######
+def stack_convdecoders(net_list, net_input_list):
+    ''' given list of N convdecoders w identical architecture, return a single
+        grouped convdecoder (num_groups=N) w the same weights + stacked input
+        s.t. output channels [n*out_depth, (n+1)*out_depth) are net_list[n]'s output '''
+
+    net0 = net_list[0]
+    num_groups = len(net_list)
+    net = Conv_Model(net0.num_layers, net0.num_channels, net0.out_depth, 
+                     net0.hidden_size, upsample_mode=net0.upsample_mode,
+                     num_groups=num_groups)
+    net = net.to(next(net0.parameters()).device)
+
+    state = net.state_dict()
+    for key, val in state.items():
+        vals = [n.state_dict()[key] for n in net_list]
+        if val.dim() == 0: # e.g. batchnorm num_batches_tracked
+            val.copy_(vals[0])
+        else: # all weights, buffers are grouped along dim 0
+            val.copy_(torch.cat(vals, 0))
+    net.train(net0.training)
+
+    net_input = torch.cat(net_input_list, 1)
+
+    return net, net_input
+
+def unstack_convdecoder(net, net_list):
+    ''' inverse of stack_convdecoders(): copy weights of group n in grouped
+        convdecoder net into net_list[n]. returns net_list '''
+
+    num_groups = len(net_list)
+    assert net.num_groups == num_groups
+
+    state_list = [n.state_dict() for n in net_list]
+    for key, val in net.state_dict().items():
+        for idx, state in enumerate(state_list):
+            if val.dim() == 0:
+                state[key].copy_(val)
+            else:
+                state[key].copy_(val.view(num_groups, -1)[idx].view(state[key].shape))
+
+    return net_list
+
 ###### OLD CODE BELOW ####################################################
 ### old model which shared layers -- introduced checkerboard artifacts ###
 
@@ -1,14 +1,22 @@
 import copy
+import contextlib
+import time
+import warnings
 import torch
 from utils.transform import fft_2d, ifft_2d, reshape_complex_vals_to_adj_channels, \
-                            reshape_adj_channels_to_complex_vals
-
-dtype = torch.cuda.FloatTensor
+                            reshape_adj_channels_to_complex_vals, ifftshift
+from utils.device import DEFAULT_DTYPE, get_device
+from include.decoder_conv import stack_convdecoders, unstack_convdecoder
+from include.checkpoint import FitCheckpoint, get_preemption
+from include.callbacks import PhaseTimer, NULL_TIMER
 
 
 def fit(ksp_masked, net, net_input, mask, mask2=None,
-        num_iter=10000, lr=0.01, dtype=torch.cuda.FloatTensor, 
-        LAMBDA_TV=1e-8):
+        num_iter=10000, lr=0.01, dtype=DEFAULT_DTYPE, 
+        LAMBDA_TV=1e-8, snapshot_every=1, snapshot_start=0,
+        stop_criteria=None, return_info=False, optimizer_state=None,
+        amp_dtype=None, compile=False, ckpt_file=None, ckpt_every=500,
+        callbacks=None):
     ''' fit a network to masked k-space measurement
         args:
             ksp_masked: masked k-space of a single slice. torch variable [1,C,H,W]
@@ -18,59 +26,270 @@ def fit(ksp_masked, net, net_input, mask, mask2=None,
             mask2: 2D mask for echo2, if applying dual mask
             num_iter: number of iterations to optimize network
             lr: learning rate
+            dtype: tensor type, e.g. torch.FloatTensor to run on cpu
+            snapshot_every: only check for a new best net every N iterations
+            snapshot_start: only check for a new best net from this iteration on,
+                            must be < num_iter. the last iteration run is always
+                            checked, incl when a stop criterion is met
+            stop_criteria: list of criteria from include.stopping, e.g. 
+                           [LossPlateau(patience=500)]. stop when any is met
+            return_info: if True, also return dict w number of iterations run,
+                         the criterion that stopped the fit, best loss, time
+            optimizer_state: adam state_dict to resume from, e.g. info['optimizer_state']
+                             of a previous fit when warm-starting an adjacent slice
+            amp_dtype: e.g. torch.bfloat16 to run the network forward pass under 
+                       autocast. the fft, mask, and loss stay in fp32, as do the
+                       weights + adam state. default None, i.e. all fp32
+            compile: if True, run forward + loss + backward of each iteration 
+                     through torch.compile, cached per architecture + img shape
+                     falls back to eager if compilation isn't available
+            ckpt_file: path to checkpoint the fit every ckpt_every iterations + on
+                       SIGTERM, after which the process exits. if the file exists, 
+                       the fit resumes from it. removed once the fit completes
+            callbacks: list of callbacks from include.callbacks, e.g. 
+                       [LossHistory(), PhaseTimes()] to record loss, time per
+                       phase, peak memory of each iteration
         returns:
             net: the best network, whose output would be in image space
     '''            
 
-    # initialize variables
     net_input = net_input.type(dtype)
-    best_net = copy.deepcopy(net)
-    best_mse = 10000.0
-    #mse_wrt_ksp, mse_wrt_img = np.zeros(num_iter), np.zeros(num_iter)
-    
-    p = [x for x in net.parameters()]
-    optimizer = torch.optim.Adam(p, lr=lr,weight_decay=0)
-    mse = torch.nn.MSELoss()
-
     img_masked = ifft_2d(ksp_masked)
 
     # convert complex [nc,x,y] --> real [2*nc,x,y] to match w net output
-    ksp_masked = reshape_complex_vals_to_adj_channels(ksp_masked).cuda()
-    img_masked = reshape_complex_vals_to_adj_channels(img_masked)[None,:].cuda()
-    mask = mask.cuda()
-    if mask2 != None:
-        mask2 = mask2.cuda()
-
-    for i in range(num_iter):
-        def closure(): # execute this for each iteration (gradient step)
-
-            optimizer.zero_grad()
-
-            out = net(net_input) # out is in img space
-
-            out_img_masked = forwardm(out, mask, mask2) # img-->ksp, mask, convert to img
-            
-            loss_img = mse(out_img_masked, img_masked)
-
-            loss_tv = (torch.sum(torch.abs(out_img_masked[:,:,:,:-1] - \
-                                           out_img_masked[:,:,:,1:])) \
-                     + torch.sum(torch.abs(out_img_masked[:,:,:-1,:] - \
-                                           out_img_masked[:,:,1:,:])))
-            loss_total = loss_img + LAMBDA_TV * loss_tv
-            
-            loss_total.backward(retain_graph=False)
-
-            return loss_total
-
-        loss = optimizer.step(closure)
-
-        # at each iteration, check if loss improves by 1%. if so, a new best net
-        loss_val = loss.data
-        if best_mse > 1.005*loss_val:
-            best_mse = loss_val
-            best_net = copy.deepcopy(net)
+    device = get_device(dtype)
+    img_masked = reshape_complex_vals_to_adj_channels(img_masked)[None,:].to(device)
+    A = ForwardOp(mask, mask2, device=device)
+
+    best_net, info = fit_loop(net, net_input, img_masked, A, num_iter, lr, LAMBDA_TV,
+                              snapshot_every, snapshot_start, stop_criteria,
+                              optimizer_state, amp_dtype, compile, ckpt_file,
+                              ckpt_every, callbacks)
+    best_net = best_net.load(copy.deepcopy(net))
+
+    if return_info:
+        return best_net, info
    
-    return best_net#, mse_wrt_ksp, mse_wrt_img
+    return best_net
+
+MSE_INIT = 10000.0 # best_mse before the first snapshot
+
+def fit_loop(net, net_input, img_masked, A, num_iter, lr, LAMBDA_TV, snapshot_every,
+             snapshot_start, stop_criteria, optimizer_state, amp_dtype, compile,
+             ckpt_file, ckpt_every, callbacks, num_heads=1, per_sample=False):
+    ''' optimization loop shared by fit(), fit_many_heads(), fit_batch()
+        args as fit(), w img_masked, A already on device, plus
+            num_heads: num of heads of a grouped net whose outputs are averaged
+            per_sample: if True, img_masked is a batch [n,2*nc,x,y] of samples,
+                        one per group of net, w best weights tracked per sample.
+                        stop criteria, callbacks see the loss summed over samples
+        returns NetSnapshot of best weights, info dict as fit() '''
+
+    if snapshot_start >= num_iter:
+        raise ValueError('snapshot_start {} must be < num_iter {}'.format(
+                            snapshot_start, num_iter))
+
+    best_net = NetSnapshot(net)
+    best_mse = torch.full((img_masked.shape[0],), MSE_INIT, device=img_masked.device) \
+               if per_sample else MSE_INIT
+    
+    p = [x for x in net.parameters()]
+    optimizer = torch.optim.Adam(p, lr=lr,weight_decay=0)
+    if optimizer_state is not None:
+        optimizer.load_state_dict(optimizer_state)
+
+    step = get_fit_step(net, net_input, img_masked, amp_dtype, compile, num_heads,
+                        per_sample)
+
+    # ||y||^2 of measured data, same in img and ksp domain b/c fft is orthonormal
+    img_energy = torch.sum(img_masked**2)
+    stop_criteria = stop_criteria or []
+    for crit in stop_criteria:
+        crit.reset()
+    stop_reason = None
+    loss_terms = {}
+    callbacks = callbacks or []
+    timer = PhaseTimer(img_masked.device) if any(cb.timing for cb in callbacks) \
+            else NULL_TIMER
+    for cb in callbacks:
+        cb.on_fit_start(num_iter)
+    t_start = time.time()
+
+    i_start = 0
+    preempt = get_preemption()
+    if ckpt_file:
+        ckpt = FitCheckpoint(ckpt_file, ckpt_every)
+        if ckpt.exists():
+            i_start, best_mse, elapsed = ckpt.load(net, best_net, optimizer, stop_criteria)
+            if per_sample:
+                best_mse = torch.tensor(best_mse, device=img_masked.device)
+            t_start -= elapsed
+            print('resuming fit from {} at iter {}'.format(ckpt_file, i_start))
+        preempt.install() # once per process, i.e. no-op if e.g. a runner did already
+
+    with preempt.deferred(): # on SIGTERM, exit at end of iteration
+        i = i_start - 1 # in case checkpoint was saved after the last iteration
+        for i in range(i_start, num_iter):
+            for cb in callbacks:
+                cb.on_iter_start(i)
+
+            def closure(): # execute this for each iteration (gradient step)
+
+                optimizer.zero_grad()
+
+                loss_total, loss_terms['img'] = step(net, net_input, img_masked, A,
+                                                     LAMBDA_TV, amp_dtype,
+                                                     num_heads, per_sample, timer=timer)
+
+                return loss_total
+
+            with timer('step'): # excl time of closure, which is timed by phase
+                loss = optimizer.step(closure)
+
+            loss_samps = loss.data
+            if per_sample: # criteria, callbacks see sum over samples
+                loss_val, loss_img = loss_samps.sum(), loss_terms['img'].sum()
+            else:
+                loss_val, loss_img = loss_samps, loss_terms['img']
+
+            if stop_criteria or callbacks:
+                # loss_img is mean over each sample, i.e. scale by numel of one sample
+                resid = torch.sqrt(loss_img * img_masked[0].numel() / img_energy)
+
+            stop = [crit for crit in stop_criteria \
+                    if crit(i, float(loss_val), float(resid))]
+            is_last = bool(stop) or i == num_iter - 1
+
+            # at each iteration, check if loss improves by 1%. if so, a new best net
+            # per sample, only the weights of samples which improved are copied
+            # always check at the last iteration, and keep it if there's no best 
+            # net yet, e.g. if stopped before snapshot_start
+            with timer('snapshot'):
+                if is_snapshot_iter(i, snapshot_every, snapshot_start) or is_last:
+                    improved = best_mse > 1.005*loss_samps
+                    if is_last:
+                        improved = improved | (torch.as_tensor(best_mse) == MSE_INIT)
+                    if per_sample and torch.any(improved):
+                        best_mse = torch.where(improved, loss_samps, best_mse)
+                        best_net.update(groups=improved)
+                    elif not per_sample and improved:
+                        best_mse = loss_samps
+                        best_net.update()
+
+            if callbacks:
+                logs = {'loss': float(loss_val), 'loss_img': float(loss_img),
+                        'resid': float(resid)}
+                if timer is not NULL_TIMER:
+                    logs['times'] = dict(timer.times)
+                    logs['mem_peak'] = timer.get_mem_peak()
+                    timer.reset()
+                for cb in callbacks:
+                    cb.on_iter_end(i, logs)
+
+            if stop:
+                stop_reason = repr(stop[0])
+                break
+
+            if ckpt_file and ckpt.is_save_iter(i):
+                with timer('checkpoint'): # logged w next iteration
+                    ckpt.save(i + 1, net, best_net, best_mse, optimizer, stop_criteria,
+                              time.time() - t_start)
+            if preempt.requested: # SIGTERM during this iteration
+                raise SystemExit('fit preempted after iter {}{}'.format(
+                                    i + 1, ', checkpoint saved' if ckpt_file else ''))
+
+    if ckpt_file:
+        ckpt.remove()
+
+    info = {'num_iter': i + 1, 'stop_reason': stop_reason, 
+            'best_loss': best_mse.tolist() if per_sample else float(best_mse),
+            'time': time.time() - t_start, 'optimizer_state': optimizer.state_dict()}
+    for cb in callbacks:
+        cb.on_fit_end(info)
+
+    return best_net, info
+
+def compute_loss(net, net_input, img_masked, A, LAMBDA_TV, amp_dtype, num_heads=1,
+                 per_sample=False, timer=NULL_TIMER):
+    ''' forward pass + loss of one fit() iteration. returns total loss, mse term
+        num_heads, per_sample: see fit_loop(). if per_sample, losses are dim [n] '''
+
+    # only reference torch.autocast if requested, as it needs torch >= 1.10
+    amp = torch.autocast(A.mask.device.type, dtype=amp_dtype) \
+                        if amp_dtype is not None else contextlib.nullcontext()
+
+    with amp, timer('forward'):
+        out = net(net_input) # out is in img space
+        if num_heads > 1: # [1,K*2*nc,x,y] --> avg over heads
+            out = out.view(num_heads, -1, out.shape[-2], out.shape[-1])
+            out = torch.mean(out, dim=0, keepdim=True)
+        elif per_sample: # [1,n*2*nc,x,y] --> [n,2*nc,x,y]
+            out = out.view(img_masked.shape)
+
+    with timer('forwardm'):
+        # img-->ksp, mask, convert to img. in fp32 if net ran under autocast
+        out_img_masked = A(out.float())
+
+    with timer('loss'):
+        if per_sample:
+            loss_img = torch.mean((out_img_masked - img_masked)**2, dim=(1,2,3))
+        else:
+            loss_img = torch.nn.functional.mse_loss(out_img_masked, img_masked)
+        loss_tv = total_variation(out_img_masked, per_sample=per_sample)
+
+    return loss_img + LAMBDA_TV * loss_tv, loss_img
+
+class FitStep():
+    ''' forward + backward of one fit() iteration, i.e. compute_loss().backward()
+        if compile, compute_loss is traced by torch.compile s.t. the network,
+        forward operator, mse and tv are fused into one graph, incl backward.
+        falls back to eager if torch.compile is unavailable or fails '''
+
+    def __init__(self, compile=False):
+        self.loss_fn = compute_loss
+        if compile and hasattr(torch, 'compile'):
+            self.loss_fn = torch.compile(compute_loss)
+
+    def __call__(self, net, *args, timer=NULL_TIMER):
+        ''' returns detached total loss, mse term
+            timer: PhaseTimer from include.callbacks to time each phase '''
+
+        try:
+            if self.loss_fn is compute_loss:
+                loss_total, loss_img = compute_loss(net, *args, timer=timer)
+            else: # one graph, so forward, forwardm, loss can't be timed separately
+                with timer('forward'):
+                    loss_total, loss_img = self.loss_fn(net, *args)
+            with timer('backward'):
+                # samples share no weights, so summing gives independent gradients
+                loss_total.sum().backward()
+        except Exception as e:
+            if self.loss_fn is compute_loss:
+                raise
+            warnings.warn('torch.compile failed, using eager fit step: {}'.format(e))
+            self.loss_fn = compute_loss
+            net.zero_grad()
+            return self(net, *args, timer=timer)
+
+        return loss_total.detach(), loss_img.detach()
+
+# compiled steps, keyed by (architecture, img shape, ...). compilation is slow 
+# relative to an iteration, so is done once per process rather than per fit
+_fit_steps = {}
+
+def get_fit_step(net, net_input, img_masked, amp_dtype=None, compile=False,
+                 num_heads=1, per_sample=False):
+    ''' return FitStep for given net, shapes, options. eager steps aren't cached '''
+
+    if not compile:
+        return FitStep()
+
+    key = (repr(net), tuple(net_input.shape), tuple(img_masked.shape),
+           img_masked.device.type, amp_dtype, num_heads, per_sample)
+    if key not in _fit_steps:
+        _fit_steps[key] = FitStep(compile=True)
+
+    return _fit_steps[key]
 
 def forwardm(img, mask, mask2=None):
     ''' convert img --> ksp (must be complex for fft), apply mask
@@ -81,8 +300,8 @@ def forwardm(img, mask, mask2=None):
         elif complex channels:
             we have nc, [re+im(e1) | re+im(e2)] '''
 
-    img = reshape_adj_channels_to_complex_vals(img[0])
-    ksp = fft_2d(img).cuda()
+    img = reshape_adj_channels_to_complex_vals(img[0]) # stays on device of img
+    ksp = fft_2d(img)
     
     if mask2==None: 
         ksp_masked_ = ksp * mask
@@ -96,76 +315,186 @@ def forwardm(img, mask, mask2=None):
 
     return reshape_complex_vals_to_adj_channels(img_masked_)[None, :]
 
-def fit_many_heads(ksp_masked, net1, net_input1, net2, net_input2,
-        mask, mask2=None, num_iter=10000, lr=0.01, 
-        dtype=torch.cuda.FloatTensor, LAMBDA_TV=1e-8):
-    ''' fit a network to masked k-space measurement
+class ForwardOp():
+    ''' forward operator img --> ksp, apply mask, convert back to img
+        numerically equivalent to forwardm(), but w/o any fftshift/ifftshift:
+        - the shifts around the mask cancel if the mask is pre-shifted, i.e.
+          ifftshift(mask * fftshift(ksp)) = ifftshift(mask) * ksp
+        - the remaining ifftshift before the fft and fftshift after the ifft
+          sum to a full period along each dim, so they cancel as well
+        hence each call only runs fft, mask multiply, ifft
+
+        mask: 2D mask, 1D mask over y (e.g. fastmri), or [n,1,x,y] for a batch 
+              of n images w separate masks
+        mask2: 2D mask for echo2, if applying dual mask. applied to 2nd half of coils
+        input dim [n,2*nc,x,y], output dim [n,2*nc,x,y] '''
+
+    def __init__(self, mask, mask2=None, device=None):
+
+        # a 1D mask is constant along x, so only needs shifting along y
+        dims = (-2,-1) if mask.dim() > 1 else (-1,)
+        mask = ifftshift(mask.float(), dim=dims)
+        if mask2 is not None: # stack to [2,1,x,y] to broadcast over each echo
+            mask = torch.stack((mask, ifftshift(mask2.float(), dim=dims)))[:, None]
+
+        self.mask = mask.to(device)
+        self.dual_mask = mask2 is not None
+
+    def __call__(self, img):
+
+        img = reshape_adj_channels_to_complex_vals(img)
+        ksp = torch.fft.fftn(img, dim=(-2,-1), norm='ortho')
+
+        if self.dual_mask: # view channels as [2,nc/2] to apply mask per echo
+            shape = ksp.shape
+            ksp_masked_ = (ksp.view(shape[:-3] + (2, -1) + shape[-2:]) * \
+                           self.mask).view(shape)
+        else:
+            ksp_masked_ = ksp * self.mask
+
+        img_masked_ = torch.fft.ifftn(ksp_masked_, dim=(-2,-1), norm='ortho')
+
+        return reshape_complex_vals_to_adj_channels(img_masked_)
+
+def fit_many_heads(ksp_masked, net_list, net_input_list, mask, mask2=None,
+        num_iter=10000, lr=0.01, dtype=DEFAULT_DTYPE, LAMBDA_TV=1e-8,
+        snapshot_every=1, snapshot_start=0, stop_criteria=None, return_info=False,
+        optimizer_state=None, amp_dtype=None, compile=False, ckpt_file=None,
+        ckpt_every=500, callbacks=None):
+    ''' fit an ensemble of K networks (heads) to masked k-space measurement,
+        where the loss is computed on the average of the heads' outputs.
+        heads are evaluated as one grouped convdecoder, and the averaged
+        img goes through a single forward operator
         args:
             ksp_masked: masked k-space of a single slice. torch variable [1,C,H,W]
-            net: original network with randomly initiated weights
-            net_input: randomly generated + scaled network input
+            net_list: list of K networks w randomly initiated weights
+            net_input_list: list of K randomly generated + scaled network inputs
             mask: 2D mask for undersampling the ksp
             mask2: 2D mask for echo2, if applying dual mask
             num_iter: number of iterations to optimize network
             lr: learning rate
+            dtype: tensor type, e.g. torch.FloatTensor to run on cpu
+            snapshot_every, snapshot_start, stop_criteria, return_info, 
+            optimizer_state, amp_dtype, compile, ckpt_file, ckpt_every, 
+            callbacks: see fit(). optimizer_state is that of the grouped net
         returns:
-            net: the best network, whose output would be in image space
+            net_list: the best K networks, whose averaged output would be in image space
     '''
 
-    # initialize variables
-    net_input1 = net_input1.type(dtype)
-    net_input2 = net_input2.type(dtype)
-    best_net1 = copy.deepcopy(net1)
-    best_net2 = copy.deepcopy(net2)
-    best_mse = 10000.0
-    #mse_wrt_ksp, mse_wrt_img = np.zeros(num_iter), np.zeros(num_iter)
-
-    #p = [x for x in net.parameters()]
-    p = [x for x in net1.parameters()] + [y for y in net2.parameters()]
-    optimizer = torch.optim.Adam(p, lr=lr,weight_decay=0)
-    mse = torch.nn.MSELoss()
-
-    img_masked = ifft_2d(ksp_masked)
+    net, net_input = stack_convdecoders(net_list, 
+                                        [n.type(dtype) for n in net_input_list])
 
     # convert complex [nc,x,y] --> real [2*nc,x,y] to match w net output
-    ksp_masked = reshape_complex_vals_to_adj_channels(ksp_masked).cuda()
-    img_masked = reshape_complex_vals_to_adj_channels(img_masked)[None,:].cuda()
-    mask = mask.cuda()
-    if mask2 != None:
-        mask2 = mask2.cuda()
-
-    for i in range(num_iter):
-        def closure(): # execute this for each iteration (gradient step)
-
-            optimizer.zero_grad()
-
-            out1 = net1(net_input1) # out is in img space
-            out2 = net2(net_input2) 
-
-            out_img_masked1 = forwardm(out1, mask, mask2) # img-->ksp, mask, convert to img
-            out_img_masked2 = forwardm(out2, mask, mask2) 
-
-            out_img_masked = torch.mean(torch.stack([out_img_masked1,
-                                                     out_img_masked2]), dim=0)
-
-            loss_img = mse(out_img_masked, img_masked)
-            loss_tv = (torch.sum(torch.abs(out_img_masked[:,:,:,:-1] - \
-                                           out_img_masked[:,:,:,1:])) \
-                     + torch.sum(torch.abs(out_img_masked[:,:,:-1,:] - \
-                                           out_img_masked[:,:,1:,:])))
-            loss_total = loss_img + LAMBDA_TV * loss_tv
-
-            loss_total.backward(retain_graph=False)
-
-            return loss_total
-
-        loss = optimizer.step(closure)
-
-        # at each iteration, check if loss improves by 1%. if so, a new best net
-        loss_val = loss.data
-        if best_mse > 1.005*loss_val:
-            best_mse = loss_val
-            best_net1 = copy.deepcopy(net1)
-            best_net2 = copy.deepcopy(net2)
+    device = get_device(dtype)
+    img_masked = reshape_complex_vals_to_adj_channels(ifft_2d(ksp_masked))[None,:].to(device)
+    A = ForwardOp(mask, mask2, device=device)
+
+    best_net, info = fit_loop(net, net_input, img_masked, A, num_iter, lr, LAMBDA_TV,
+                              snapshot_every, snapshot_start, stop_criteria,
+                              optimizer_state, amp_dtype, compile, ckpt_file,
+                              ckpt_every, callbacks, num_heads=len(net_list))
+
+    best_net_list = [copy.deepcopy(n) for n in net_list]
+    best_net_list = unstack_convdecoder(best_net.load(net), best_net_list)
+
+    if return_info:
+        return best_net_list, info
+
+    return best_net_list
+
+def fit_batch(ksp_masked_list, net_list, net_input_list, mask_list,
+              num_iter=10000, lr=0.01, dtype=DEFAULT_DTYPE, LAMBDA_TV=1e-8,
+              snapshot_every=1, snapshot_start=0, stop_criteria=None, 
+              return_info=False, optimizer_state=None, amp_dtype=None, 
+              compile=False, ckpt_file=None, ckpt_every=500, callbacks=None):
+    ''' fit N independent networks, e.g. one per slice or file, in a single
+        forward/backward pass. networks are evaluated as one grouped convdecoder,
+        so each sample's loss only updates its own weights. equivalent to 
+        calling fit() on each (ksp_masked, net, net_input, mask) separately
+        args:
+            ksp_masked_list: list of N masked k-space slices, each [nc,x,y]
+            net_list: list of N networks w identical architecture
+            net_input_list: list of N network inputs
+            mask_list: list of N 2D masks, one per slice
+            num_iter, lr, dtype, LAMBDA_TV, snapshot_every, snapshot_start, 
+            return_info, optimizer_state, amp_dtype, compile, ckpt_file, 
+            ckpt_every, callbacks: see fit()
+            stop_criteria: see fit(), applied to the loss summed over samples, 
+                           i.e. all samples stop together
+        returns:
+            net_list: the best network for each sample, tracked separately
+            info: if return_info, w best_loss a list of N per-sample losses
+    '''
 
-    return best_net1, best_net2
+    num_samps = len(net_list)
+    assert len(ksp_masked_list) == len(net_input_list) == len(mask_list) == num_samps
+
+    device = get_device(dtype)
+    net, net_input = stack_convdecoders(net_list, 
+                                        [n.type(dtype) for n in net_input_list])
+
+    # convert complex [n,nc,x,y] --> real [n,2*nc,x,y] to match w net output
+    ksp_masked = torch.stack(ksp_masked_list)
+    img_masked = reshape_complex_vals_to_adj_channels(ifft_2d(ksp_masked)).to(device)
+    A = ForwardOp(torch.stack(mask_list)[:, None], device=device) # mask [n,1,x,y]
+
+    best_net, info = fit_loop(net, net_input, img_masked, A, num_iter, lr, LAMBDA_TV,
+                              snapshot_every, snapshot_start, stop_criteria,
+                              optimizer_state, amp_dtype, compile, ckpt_file,
+                              ckpt_every, callbacks, per_sample=True)
+
+    best_net_list = [copy.deepcopy(n) for n in net_list]
+    best_net_list = unstack_convdecoder(best_net.load(net), best_net_list)
+
+    if return_info:
+        return best_net_list, info
+
+    return best_net_list
+
+class NetSnapshot():
+    ''' preallocated copy of a network's parameters + buffers, used to track the
+        best network during fitting. update() copies in place, i.e. no
+        reallocation of the model each time the loss improves '''
+
+    def __init__(self, net):
+        # parameters + buffers are updated in place by optimizer / batchnorm,
+        # so these references stay valid for the lifetime of the fit
+        self.src = list(net.state_dict(keep_vars=True).values())
+        self.state = {k: v.detach().clone() for k, v in net.state_dict().items()}
+        self.dst = list(self.state.values())
+
+    @torch.no_grad()
+    def update(self, groups=None):
+        ''' copy current weights of the net passed to __init__() into snapshot
+            groups: bool tensor [num_groups], for a grouped convdecoder only 
+                    copy weights of groups set to True '''
+
+        if groups is None:
+            for s, d in zip(self.src, self.dst):
+                d.copy_(s)
+            return
+
+        num_groups = groups.shape[0]
+        for s, d in zip(self.src, self.dst):
+            if d.dim() == 0: # e.g. batchnorm num_batches_tracked
+                d.copy_(s)
+            else: # all weights, buffers are grouped along dim 0
+                d.view(num_groups, -1)[groups] = s.detach().view(num_groups, -1)[groups]
+
+    def load(self, net):
+        ''' load snapshot weights into net, return net '''
+        net.load_state_dict(self.state)
+        return net
+
+def total_variation(img, per_sample=False):
+    ''' anisotropic tv, i.e. sum of abs differences along spatial dims (x,y)
+        if per_sample, sum over all but the first dim, i.e. one tv per sample '''
+
+    sum_dims = tuple(range(1, img.dim())) if per_sample else tuple(range(img.dim()))
+
+    return torch.sum(torch.abs(img[...,:-1] - img[...,1:]), dim=sum_dims) \
+         + torch.sum(torch.abs(img[...,:-1,:] - img[...,1:,:]), dim=sum_dims)
+
+def is_snapshot_iter(i, snapshot_every=1, snapshot_start=0):
+    ''' whether to check for a new best net at iteration i '''
+    return i >= snapshot_start and (i - snapshot_start) % snapshot_every == 0
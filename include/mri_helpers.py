@@ -1,40 +1,183 @@
 ''' mri-specific helper functions '''
 
 import os.path
+import re
+from collections import OrderedDict
 import torch 
 import numpy as np
 import math
 import sigpy
+import sigpy.mri
+from concurrent.futures import ProcessPoolExecutor
 
 path_m = os.path.abspath(os.path.join(os.path.dirname(__file__),'..')) + '/masks/'
 
-def apply_mask(ksp_orig, accel, calib=None, expmt=False):
+def apply_mask(ksp_orig, accel, calib=None, expmt=False, seed=None, device=None):
     ''' apply mask
         default: 512x80 mask zero padded to 512x160, w a 64x64 calib region 
         to choose custom calib region, expmt flag must be True
 
+        expmt mode picks one of the random variants of the mask. seed makes
+        this choice reproducible, e.g. seed=[job_seed, int(file_id), accel]
+        masks are cached on device (default ksp_orig.device), see MaskRegistry
+
         to generate new masks, use generate_poisson_disc() function below
     '''
 
     assert ksp_orig.shape[-2:] == (512, 160)
 
-    if expmt: # flag to use experimental sampling masks v default
-        path_m = path_m + 'expmt/{}x/'.format(accel)
+    if device is None:
+        device = ksp_orig.device
+    registry = get_mask_registry()
 
-        if calib == 999: # sample calibration region, nothing else
+    if expmt: # flag to use experimental sampling masks v default
+        if calib == CALIB_MAX: # sample calibration region, nothing else
             # for 4x: 128x80 1's. for 8x: 72x72 1's
-            mask_fn = '{}/mask_pd_{}x_calib_max.npy'.format(path_m, accel)
+            mask = registry.get(accel, CALIB_MAX, device=device)
         else:
-            rr = np.random.randint(0, high=20)
-            mask_fn = '{}{}/mask_pd_{}x_calib{}_rand{}.npy'.format(
-                    path_m, calib, accel, calib, rr)
+            mask = registry.sample(accel, calib, seed=seed, device=device)
     else: # default mask uses 64x64 calib region
-        mask_fn = '{}pd_{}x_calib64.npy'.format(path_m, accel)
-
-    mask = torch.from_numpy(np.load(mask_fn))
-    mask = mask.type(torch.uint8)
+        mask = registry.get(accel, 64, device=device)
 
     return ksp_orig * mask, mask
+
+CALIB_MAX = 999 # calib value of masks which sample the calibration region only
+
+class MaskRegistry():
+    ''' index of all masks under path, keyed by (accel, calib, variant) where
+            pd_{accel}x_calib{calib}.npy                    --> variant None
+            expmt/.../mask_pd_{accel}x_calib{calib}_rand{rr}.npy --> variant rr
+            expmt/.../mask_pd_{accel}x_calib_max.npy        --> calib CALIB_MAX
+            {name}.npz banks from save_mask_bank()          --> variant ('bank', name, seed)
+        i.e. bank masks have their own key space, s.t. they can't collide w the
+        npy masks, and each bank may have its own shape, e.g. for another img_shape
+        masks are loaded lazily into an lru cache of max_cached uint8 tensors,
+        one per (key, device), s.t. repeated calls cost no i/o or transfers.
+        get() returns a clone, s.t. callers can't modify the cached mask '''
+
+    def __init__(self, path=path_m, max_cached=64, seed=None):
+        self.path = path
+        self.max_cached = max_cached
+        self.index = self.build_index(path)
+        self.cache = OrderedDict()
+        self.banks = {} # filename --> masks array of each bank, once loaded
+        self.rng = np.random.default_rng(seed) # used if no seed passed to sample()
+
+    @staticmethod
+    def build_index(path):
+        ''' return dict (accel, calib, variant) --> filename, or
+            (filename, idx) for masks in a bank
+            raises ValueError if two masks share a key, e.g. two banks w the same
+            name, or if npy masks differ in shape. banks aren't checked against
+            the npy masks or each other, as all masks of a bank share a shape '''
+
+        pattern = re.compile(r'pd_(\d+)x_calib(\d+|_max)(?:_rand(\d+))?\.npy$')
+
+        index, shapes = {}, {}
+        def add(key, entry):
+            if key in index:
+                raise ValueError('mask w accel {}, calib {}, variant {} in both {} and {}'
+                                 .format(*key, index[key], entry))
+            index[key] = entry
+
+        for root, _, files in os.walk(path):
+            for fn in files:
+                if fn.endswith('.npz'): # only reads params, not masks
+                    name, fn = fn[:-len('.npz')], os.path.join(root, fn)
+                    with np.load(fn) as bank:
+                        params = zip(bank['accel'], bank['calib'], bank['seed'])
+                        for idx, (accel, calib, seed) in enumerate(params):
+                            add((int(accel), int(calib), ('bank', name, int(seed))),
+                                (fn, idx))
+                    continue
+                match = pattern.search(fn)
+                if match is None:
+                    continue
+                accel, calib, variant = match.groups()
+                calib = CALIB_MAX if calib == '_max' else int(calib)
+                variant = None if variant is None else int(variant)
+                fn = os.path.join(root, fn)
+
+                shape = np.load(fn, mmap_mode='r').shape # reads header only
+                if shapes and shape not in shapes:
+                    shape_ref, fn_ref = next(iter(shapes.items()))
+                    raise ValueError('mask {} has shape {}, but {} has shape {}'.format(
+                                                    fn, shape, fn_ref, shape_ref))
+                shapes.setdefault(shape, fn)
+                add((int(accel), calib, variant), fn)
+
+        return index
+
+    def get_variants(self, accel, calib, bank=None):
+        ''' return sorted list of random variants for given accel, calib, i.e.
+            the _rand variants, or if bank is given, the variants of that bank '''
+
+        if bank is None:
+            is_variant = lambda v: isinstance(v, int)
+        else:
+            is_variant = lambda v: isinstance(v, tuple) and v[1] == bank
+
+        return sorted(v for (a, c, v) in self.index if (a, c) == (accel, calib) \
+                                                        and is_variant(v))
+
+    def get(self, accel, calib=64, variant=None, device='cpu'):
+        ''' return mask as uint8 tensor on device. a copy of the cached mask, i.e.
+            an on-device clone rather than a reload
+            for a mask in a bank, variant is ('bank', name, seed) '''
+
+        key = (accel, calib, variant, str(torch.device(device)))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key].clone()
+
+        if key[:3] not in self.index:
+            raise KeyError('no mask w accel {}, calib {}, variant {} in {}'.format(
+                                                accel, calib, variant, self.path))
+
+        mask = torch.from_numpy(self.load_mask(self.index[key[:3]]))
+        mask = mask.type(torch.uint8).to(device)
+
+        self.cache[key] = mask
+        if len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+        return mask.clone()
+
+    def load_mask(self, entry):
+        ''' return np array of mask given index entry '''
+
+        if isinstance(entry, str):
+            return np.load(entry)
+
+        filename, idx = entry
+        if filename not in self.banks:
+            with np.load(filename) as bank:
+                self.banks[filename] = bank['masks']
+
+        return self.banks[filename][idx]
+
+    def sample(self, accel, calib, seed=None, device='cpu', bank=None):
+        ''' return random variant of mask. if seed is None, draw from registry rng
+            if bank is given, sample from the masks of that bank '''
+
+        variants = self.get_variants(accel, calib, bank)
+        if len(variants) == 0:
+            raise KeyError('no mask variants w accel {}, calib {}, bank {} in {}'.format(
+                                                        accel, calib, bank, self.path))
+
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        variant = variants[rng.integers(len(variants))]
+
+        return self.get(accel, calib, variant, device)
+
+_mask_registry = None
+
+def get_mask_registry():
+    ''' return module-level registry s.t. cached masks persist across calls '''
+    global _mask_registry
+    if _mask_registry is None:
+        _mask_registry = MaskRegistry()
+    return _mask_registry
     
 def apply_dual_mask(ksp_orig, accel):
     ''' given echo1, echo2 concatenated together 
@@ -139,24 +282,81 @@ def generate_t2_map(echo1, echo2, hdr = None, mask = None,
     # Return the T2 map and tuple for non-zero mean and std of the T2 map
     return t2map, (np.around(tmp_mean, 2), np.around(tmp_std, 2))
 
-def generate_poisson_disc(accel, img_shape=(512,80), calib=(24,24), seed=None):
-    ''' create a poisson disc mask shape (512,80) w calib region
-        zero pad to (512,160) to match qdess zero padding '''
+def generate_poisson_disc(accel, img_shape=(512,80), calib=(24,24), seed=None,
+                          pad_shape=(512,160), verbose=True):
+    ''' create a poisson disc mask shape img_shape w calib region
+        zero pad to pad_shape, default (512,160) to match qdess zero padding
+        pad_shape=None for no padding '''
 
     mask = sigpy.mri.samp.poisson(img_shape=img_shape, accel=accel,
                                   calib=calib, seed=seed,
                                   crop_corner=False, max_attempts=10)
     mask = abs(torch.from_numpy(mask)).type(torch.uint8)
 
-    accel_ = (img_shape[0]*img_shape[1]) / torch.sum(mask)
-    print('given accel {}, actual accel {}'.format(
-        accel, np.around(accel_,4)))
+    if verbose:
+        print('given accel {}, actual accel {}'.format(
+            accel, np.around(get_accel(mask),4)))
 
-    assert img_shape == (512,80)
-    mask_ = torch.zeros((512,160))
-    mask_[:, 40:120] = mask
+    return pad_mask(mask, pad_shape)
+
+def get_accel(mask):
+    ''' return actual acceleration of a mask, i.e. num pixels / num sampled '''
+    return float(mask.numel() / mask.sum())
+
+def pad_mask(mask, pad_shape=None):
+    ''' center mask in zeros of pad_shape, e.g. (512,80) --> (512,160) '''
+
+    if pad_shape is None or tuple(pad_shape) == tuple(mask.shape):
+        return mask
+
+    mask_ = torch.zeros(pad_shape, dtype=mask.dtype)
+    x0, y0 = [(p - m) // 2 for p, m in zip(pad_shape, mask.shape)]
+    mask_[x0:x0+mask.shape[0], y0:y0+mask.shape[1]] = mask
+
+    return mask_
 
-    return mask_.type(torch.uint8)
+def generate_mask_bank(accel_list, calib_list, seed_list, img_shape=(512,80),
+                       pad_shape=(512,160), num_workers=None):
+    ''' generate a poisson disc mask for every (accel, calib, seed) in a process pool
+        calib is the side length of a square calib region, as in pd_4x_calib64.npy
+
+        returns dict of arrays, one entry per mask, s.t. it can be stored w
+        save_mask_bank() and loaded by MaskRegistry
+                masks: uint8 dim (num_masks, *pad_shape)
+                accel, calib, seed: mask parameters
+                accel_actual: achieved acceleration over img_shape, i.e. excl padding '''
+
+    jobs = [(accel, calib, seed, tuple(img_shape), pad_shape) for accel in accel_list \
+                                    for calib in calib_list for seed in seed_list]
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    chunksize = max(1, len(jobs) // (4 * num_workers))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(_generate_bank_mask, jobs, chunksize=chunksize))
+
+    return {'masks': np.stack([mask for mask, _ in results]),
+            'accel': np.array([job[0] for job in jobs]),
+            'calib': np.array([job[1] for job in jobs]),
+            'seed': np.array([job[2] for job in jobs]),
+            'accel_actual': np.array([accel_ for _, accel_ in results]),
+            'img_shape': np.array(img_shape)}
+
+def _generate_bank_mask(job):
+    ''' worker for generate_mask_bank(), must be top-level to be pickled '''
+
+    accel, calib, seed, img_shape, pad_shape = job
+    mask = generate_poisson_disc(accel, img_shape, (calib, calib), seed,
+                                 pad_shape=None, verbose=False)
+
+    return pad_mask(mask, pad_shape).numpy(), get_accel(mask)
+
+def save_mask_bank(filename, bank):
+    ''' save output of generate_mask_bank() as a single compressed archive
+        if saved under masks/ as {name}.npz, MaskRegistry indexes each mask w
+        variant ('bank', name, seed) '''
+    np.savez_compressed(filename, **bank)
 
 #############################################################################
 ### OLD CODE BELOW ##########################################################
@@ -196,3 +396,34 @@ def sample_rectangular_central_region(mask):
     mask[mid_y-len_y:mid_y+len_y, mid_z-len_z:mid_z+len_z] = 1
 
     return mask
+
+if __name__ == '__main__':
+
+    # generate mask bank, e.g. a per-file mask set for a cohort
+    # python -m include.mri_helpers --filename bank_cohort.npz --accel_list 4 8 \
+    #                               --file_id_list 005 006 ...
+    # to use it via MaskRegistry, move it under masks/
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accel_list', nargs='+', type=int, default=[4, 8])
+    parser.add_argument('--calib_list', nargs='+', type=int, default=[64])
+    parser.add_argument('--num_seeds', type=int, default=20) # seeds 0,...,N-1
+    parser.add_argument('--file_id_list', nargs='+', default=None) # ... or seed=int(file_id)
+    parser.add_argument('--img_shape', nargs=2, type=int, default=[512, 80])
+    parser.add_argument('--pad_shape', nargs=2, type=int, default=[512, 160])
+    parser.add_argument('--num_workers', type=int, default=None) # default all cores
+    parser.add_argument('--filename', type=str, required=True) # e.g. bank_cohort.npz
+    args = parser.parse_args()
+
+    seed_list = range(args.num_seeds) if args.file_id_list is None else \
+                [int(file_id) for file_id in args.file_id_list]
+
+    bank = generate_mask_bank(args.accel_list, args.calib_list, seed_list,
+                              args.img_shape, args.pad_shape, args.num_workers)
+    save_mask_bank(args.filename, bank)
+
+    for accel in args.accel_list:
+        accel_ = bank['accel_actual'][bank['accel'] == accel]
+        print('accel {}: actual {:.3f} +/- {:.3f}'.format(accel, accel_.mean(), accel_.std()))
+    print('saved {} masks to {}'.format(len(bank['masks']), args.filename))
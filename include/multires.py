@@ -0,0 +1,112 @@
+''' coarse-to-fine fitting of a convdecoder
+
+    early iterations of fit() mostly fit low frequencies, yet the full network
+    synthesizes a full resolution image from iteration 0. instead, first fit a
+    truncated decoder, i.e. the first m upsampling blocks followed by the final
+    conv layers, whose output has size hidden_size[m-1], to the central region
+    of k-space. then grow to more blocks, reusing the learned weights, until
+    the full network is fit at full resolution '''
+
+import time
+import torch
+import torch.nn as nn
+
+from include.fit import fit
+from utils.device import DEFAULT_DTYPE
+
+NUM_MODULES_BLOCK = 4 # modules per upsampling block, i.e. upsample, conv, relu, bn
+
+
+def get_truncated_decoder(net, num_blocks):
+    ''' return decoder w the first num_blocks upsampling blocks of net + its final
+        layers. modules are shared w net, i.e. fitting it updates net's weights
+        num_blocks = net.num_layers - 1 gives the full network '''
+
+    assert 1 <= num_blocks <= net.num_layers - 1
+
+    modules = list(net.net)
+    return nn.Sequential(*modules[:NUM_MODULES_BLOCK*num_blocks],
+                         *modules[-NUM_MODULES_BLOCK:])
+
+def crop_ksp(ksp, mask, size):
+    ''' crop central region of centered k-space + mask to size (x,y)
+        ksp is scaled by sqrt(xy / XY), s.t. w ortho ffts the img of the cropped 
+        ksp has the same magnitude as the full resolution img '''
+
+    (nx, ny), (cx, cy) = ksp.shape[-2:], size
+    x0, y0 = nx//2 - cx//2, ny//2 - cy//2
+
+    ksp_c = ksp[..., x0:x0+cx, y0:y0+cy] * ((cx*cy) / (nx*ny))**0.5
+
+    return ksp_c, crop_mask(mask, (nx, ny), size)
+
+def crop_mask(mask, shape, size):
+    ''' crop central region of mask for centered k-space of shape (x,y) to size '''
+
+    (nx, ny), (cx, cy) = shape, size
+    x0, y0 = nx//2 - cx//2, ny//2 - cy//2
+
+    if mask.dim() == 1: # 1D mask over y
+        return mask[y0:y0+cy]
+
+    return mask[..., x0:x0+cx, y0:y0+cy]
+
+def fit_multires(ksp_masked, net, net_input, mask, block_list=None, num_iter_list=None,
+                 dtype=DEFAULT_DTYPE, mask2=None, stop_criteria=None, snapshot_start=0,
+                 return_info=False, **kwargs):
+    ''' fit net coarse-to-fine, one stage per entry of block_list
+
+        parameters:
+                block_list: number of upsampling blocks per stage, increasing, 
+                            e.g. [4, 6, 7]. last entry must be net.num_layers-1, 
+                            i.e. the final stage fits the full network
+                num_iter_list: iterations per stage, e.g. [1000, 1000, 8000]
+                mask2: 2D mask for echo2, if applying dual mask. cropped as mask
+                stop_criteria: applied to the final stage only, b/c losses of 
+                               coarse stages aren't comparable to full resolution
+                snapshot_start: applied to the final stage only, b/c it's usually
+                                beyond the iterations of a coarse stage
+                kwargs: passed to fit() for every stage, e.g. lr, LAMBDA_TV
+        returns:
+                net: the best network of the final stage
+                info: if return_info, dict from fit() of the final stage, plus
+                      'stages' w (num_blocks, size, num_iter, time) of each stage
+                      'time' of all stages combined '''
+
+    num_full = net.num_layers - 1
+    if block_list is None:
+        block_list = [num_full - 3, num_full - 1, num_full]
+    if num_iter_list is None:
+        num_iter_list = [1000] * (len(block_list) - 1) + [10000]
+    assert block_list[-1] == num_full and len(block_list) == len(num_iter_list)
+
+    stages = []
+    t_start = time.time()
+
+    for num_blocks, num_iter in zip(block_list[:-1], num_iter_list[:-1]):
+
+        size = net.hidden_size[num_blocks - 1]
+        ksp_c, mask_c = crop_ksp(ksp_masked, mask, size)
+        mask2_c = crop_mask(mask2, ksp_masked.shape[-2:], size) if mask2 is not None \
+                                                                 else None
+        net_c = get_truncated_decoder(net, num_blocks)
+
+        t0 = time.time()
+        best_net_c = fit(ksp_c, net_c, net_input, mask_c, mask2=mask2_c,
+                         num_iter=num_iter, dtype=dtype, **kwargs)
+        net_c.load_state_dict(best_net_c.state_dict()) # i.e. into shared modules of net
+        stages.append((num_blocks, tuple(size), num_iter, time.time() - t0))
+
+    # full network at full resolution
+    t0 = time.time()
+    net, info = fit(ksp_masked, net, net_input, mask, mask2=mask2,
+                    num_iter=num_iter_list[-1], dtype=dtype, stop_criteria=stop_criteria,
+                    snapshot_start=snapshot_start, return_info=True, **kwargs)
+    stages.append((num_full, tuple(ksp_masked.shape[-2:]), info['num_iter'], 
+                   time.time() - t0))
+
+    if return_info:
+        info.update({'stages': stages, 'time': time.time() - t_start})
+        return net, info
+
+    return net
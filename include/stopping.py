@@ -0,0 +1,118 @@
+''' stopping criteria for fit(), checked once per iteration
+
+    each criterion is called as crit(i, loss, resid) w
+        i: current iteration
+        loss: total loss at iteration i
+        resid: relative k-space residual ||M*F(out) - y|| / ||y||
+    and returns True when fitting should stop '''
+
+import time
+import numpy as np
+
+
+class StopCriterion():
+    ''' base class for stopping criteria '''
+
+    def reset(self):
+        ''' called once at the start of each fit '''
+        pass
+
+    def state_dict(self):
+        ''' state to checkpoint s.t. a resumed fit stops at the same iteration '''
+        return dict(vars(self))
+
+    def load_state_dict(self, state):
+        vars(self).update(state)
+
+    def __call__(self, i, loss, resid):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class LossPlateau(StopCriterion):
+    ''' stop once loss hasn't improved by a relative min_delta in patience iterations '''
+
+    def __init__(self, patience=500, min_delta=1e-3):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.reset()
+
+    def reset(self):
+        self.best_loss = np.inf
+        self.num_bad_iter = 0
+
+    def __call__(self, i, loss, resid):
+        if loss < (1 - self.min_delta) * self.best_loss:
+            self.best_loss = loss
+            self.num_bad_iter = 0
+        else:
+            self.num_bad_iter += 1
+        return self.num_bad_iter >= self.patience
+
+    def __repr__(self):
+        return 'LossPlateau(patience={}, min_delta={})'.format(
+                                    self.patience, self.min_delta)
+
+class KspaceResidual(StopCriterion):
+    ''' stop once relative residual w.r.t. measured k-space drops below threshold '''
+
+    def __init__(self, threshold=1e-2):
+        self.threshold = threshold
+
+    def __call__(self, i, loss, resid):
+        return resid < self.threshold
+
+    def __repr__(self):
+        return 'KspaceResidual(threshold={})'.format(self.threshold)
+
+class WallClock(StopCriterion):
+    ''' stop once max_seconds have elapsed since the start of the fit '''
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+        self.reset()
+
+    def reset(self):
+        self.t_start = time.time()
+
+    def __call__(self, i, loss, resid):
+        return time.time() - self.t_start > self.max_seconds
+
+    def state_dict(self): # elapsed, not start time, s.t. time spent preempted isn't counted
+        return {'max_seconds': self.max_seconds, 'elapsed': time.time() - self.t_start}
+
+    def load_state_dict(self, state):
+        self.max_seconds = state['max_seconds']
+        self.t_start = time.time() - state['elapsed']
+
+    def __repr__(self):
+        return 'WallClock(max_seconds={})'.format(self.max_seconds)
+
+class TargetLoss(StopCriterion):
+    ''' stop once loss reaches target, e.g. to measure time-to-target of a schedule '''
+
+    def __init__(self, target):
+        self.target = target
+
+    def __call__(self, i, loss, resid):
+        return loss <= self.target
+
+    def __repr__(self):
+        return 'TargetLoss(target={})'.format(self.target)
+
+def get_stop_criteria(patience=None, min_delta=1e-3, tol_resid=None, max_time=None,
+                      target_loss=None):
+    ''' build list of criteria from run script args. None disables a criterion '''
+
+    stop_criteria = []
+    if target_loss:
+        stop_criteria.append(TargetLoss(target_loss))
+    if patience:
+        stop_criteria.append(LossPlateau(patience, min_delta))
+    if tol_resid:
+        stop_criteria.append(KspaceResidual(tol_resid))
+    if max_time:
+        stop_criteria.append(WallClock(max_time))
+
+    return stop_criteria
@@ -0,0 +1,95 @@
+''' slice-by-slice volume reconstruction w warm starts
+
+    adjacent slices of a volume are nearly identical, so rather than fitting
+    each slice from a random init, initialize slice n+1 w the fitted weights
+    (and optionally adam state) of slice n and run a much shorter fit.
+    slices are swept outward from the center s.t. every warm start comes from
+    a neighbor one slice closer to the center '''
+
+import copy
+
+from include.decoder_conv import init_convdecoder
+from include.fit import fit
+from utils.device import DEFAULT_DTYPE
+
+
+def get_sweep_order(idx_list, idx_center=None):
+    ''' given list of slice indices, return (idx, idx_src) pairs in fitting order
+        idx_src is the neighbor to warm start from, None for the center slice
+        e.g. idx_list [3,4,5,6,7] --> (5,None), (6,5), (4,5), (7,6), (3,4) '''
+
+    idx_list = sorted(idx_list)
+    if idx_center is None:
+        idx_center = idx_list[len(idx_list) // 2]
+    if idx_center not in idx_list:
+        raise ValueError('center slice {} not in idx_list'.format(idx_center))
+
+    above = [idx for idx in idx_list if idx > idx_center]
+    below = [idx for idx in idx_list if idx < idx_center][::-1]
+
+    order = [(idx_center, None)]
+    for n in range(max(len(above), len(below))):
+        if n < len(above):
+            order.append((above[n], above[n-1] if n else idx_center))
+        if n < len(below):
+            order.append((below[n], below[n-1] if n else idx_center))
+
+    return order
+
+def fit_volume(get_ksp, idx_list, mask, idx_center=None, num_iter=10000,
+               num_iter_warm=1000, warm_start=True, warm_optimizer=False,
+               dtype=DEFAULT_DTYPE, stop_criteria=None, **kwargs):
+    ''' generator which fits a convdecoder to each slice in idx_list, sweeping
+        outward from idx_center. yields one result per slice in fitting order
+
+        parameters:
+                get_ksp: function idx --> original, unmasked k-space of slice idx
+                idx_list: slice indices to reconstruct
+                mask: sampling mask applied to every slice
+                num_iter: iterations for the center slice, or any cold start
+                num_iter_warm: iterations for slices warm started from a neighbor
+                warm_start: if False, fit every slice from the random init,
+                            e.g. as a reference for warm starts
+                warm_optimizer: also carry over adam state from the neighbor
+                kwargs: passed to fit(), e.g. LAMBDA_TV, snapshot_every
+        yields:
+                idx: slice index
+                net: fitted convdecoder
+                net_input: input seed for net
+                ksp_masked: masked, scaled k-space of slice idx
+                ksp_orig_: unmasked k-space of slice idx w the same scaling
+                info: dict from fit(), plus 'warm_start' = idx_src or None '''
+
+    # most recent fit on each side of the center. sweep order guarantees this
+    # is always the neighbor of the next slice on that side
+    prev = {}
+
+    for idx, idx_src in get_sweep_order(idx_list, idx_center):
+
+        # init from scratch to get the scale factor w.r.t. the random net, s.t.
+        # k-space of every slice is scaled identically to a cold start
+        net, net_input, ksp_orig_ = init_convdecoder(get_ksp(idx), dtype=dtype)
+        ksp_masked = ksp_orig_ * mask
+
+        side = 0 if idx_src is None else (1 if idx > idx_src else -1)
+        is_warm = warm_start and idx_src is not None
+        optimizer_state = None
+        if is_warm:
+            net.load_state_dict(prev[side]['net'])
+            if warm_optimizer:
+                optimizer_state = prev[side]['optimizer_state']
+
+        net, info = fit(ksp_masked=ksp_masked, net=net, net_input=net_input,
+                        mask=mask, num_iter=num_iter_warm if is_warm else num_iter,
+                        dtype=dtype, stop_criteria=stop_criteria, return_info=True,
+                        optimizer_state=optimizer_state, **kwargs)
+        info['warm_start'] = idx_src if is_warm else None
+
+        state = {'net': copy.deepcopy(net.state_dict()),
+                 'optimizer_state': info['optimizer_state']}
+        if side == 0:
+            prev[1] = prev[-1] = state
+        else:
+            prev[side] = state
+
+        yield idx, net, net_input, ksp_masked, ksp_orig_, info
@@ -1,4 +1,5 @@
 import os.path
+from collections import OrderedDict
 from os import listdir
 from os.path import isfile, join
 import numpy as np
@@ -89,47 +90,220 @@ def load_h5_fastmri(file_id, slice_idx=None, demo=False):
 
     return f, slice_ksp
 
-def load_qdess(file_id, idx_kx=None, sample=False):
-    ''' load qdess w shortcut if pre-saved npy slice exists 
-        default idx_kx is central in kx (axial) b/c we undersample in (ky,kz)'''
+def load_qdess(file_id, idx_kx=None, sample=False, cache=True):
+    ''' load qdess slice, default idx_kx is central in kx (axial) b/c we undersample in (ky,kz)
+        if cache, read from the preprocessed slice cache if populated, i.e. by 
+        precompute_cache(). the cache is never written here. else read from h5 '''
 
     if sample:
         raise NotImplementedError('data not publically available')
 
+    if cache:
+        ksp = load_cached_slice(file_id, idx_kx)
+        if ksp is not None:
+            return ksp
+
+    # legacy shortcut for central slice, pre-dates the slice cache
     file_in = '/bmrNAS/people/dvv/in_qdess/central_slice_in_kx/MTR_{}.npy'.format(file_id)
-    
-    if os.path.exists(file_in) and not idx_kx:
+    if os.path.exists(file_in) and idx_kx is None:
         return torch.from_numpy(np.load(file_in))
-    
-    else:
-        
-        ksp = load_h5_qdess(file_id)
 
-        if idx_kx == None:
-            idx_kx = ksp.shape[0] // 2
-       
-        # reshape, concat echo1 + echo2
-        ksp_echo1 = ksp[:,:,:,0,:].permute(3,0,1,2)[:, idx_kx, :, :]
-        ksp_echo2 = ksp[:,:,:,1,:].permute(3,0,1,2)[:, idx_kx, :, :]
-        ksp_orig = torch.cat((ksp_echo1, ksp_echo2), 0)
+    # read only slice idx_kx from h5 rather than the full volume
+    return get_qdess_reader().read_slice(file_id, idx_kx)
+
+def get_qdess_shape(file_id, cache=True):
+    ''' shape (kx,ky,kz,echo,coil) of qdess volume. if cache, read from the slice
+        cache if populated, s.t. the h5 file isn't opened '''
+
+    fn = get_cache_dir(file_id) + 'shape.npy'
+    if cache and os.path.exists(fn):
+        return tuple(int(n) for n in np.load(fn))
+
+    return get_qdess_reader().get_shape(file_id)
 
-        return ksp_orig
+def get_qdess_slice(ksp, idx_kx):
+    ''' given qdess volume ksp dim (kx,ky,kz,echo,coil), return slice idx_kx
+        w echo1 + echo2 concatenated along coil dim, i.e. dim (2*nc,ky,kz) '''
+
+    # reshape, concat echo1 + echo2
+    ksp_echo1 = ksp[:,:,:,0,:].permute(3,0,1,2)[:, idx_kx, :, :]
+    ksp_echo2 = ksp[:,:,:,1,:].permute(3,0,1,2)[:, idx_kx, :, :]
+    ksp_orig = torch.cat((ksp_echo1, ksp_echo2), 0)
+
+    return ksp_orig
+
+def get_slice_name(file_id, idx_kx=None):
+    ''' output filename prefix for a qdess slice. central slice (idx_kx=None)
+        keeps the MTR_xxx naming used by load_imgs() '''
+    if idx_kx is None:
+        return 'MTR_{}'.format(file_id)
+    return 'MTR_{}_kx{}'.format(file_id, idx_kx)
+
+PATH_QDESS = '/bmrNAS/people/arjun/data/qdess_knee_2020/files_recon_calib-16/'
 
 def load_h5_qdess(file_id):
-    ''' given file_id, return the h5 file '''
+    ''' given file_id, return full ksp volume dim (kx,ky,kz,echo,coil)
+        to load individual slices, use QDessReader instead '''
 
-    path_in = '/bmrNAS/people/arjun/data/qdess_knee_2020/files_recon_calib-16/'
-    filename = '{}MTR_{}.h5'.format(path_in, file_id)
+    filename = '{}MTR_{}.h5'.format(PATH_QDESS, file_id)
 
     f = h5py.File(filename, 'r')
     try:
         ksp = torch.from_numpy(f['kspace'][()])
     except KeyError:
-        print('No kspace in file {} w keys {}'.format(fn, f.keys()))
+        print('No kspace in file {} w keys {}'.format(filename, f.keys()))
     f.close()
 
     return ksp
 
+class QDessReader():
+    ''' read individual kx slices of qdess k-space via hdf5 hyperslab selection,
+        i.e. only the requested slice(s) + echoes are read from disk, instead of 
+        the full (kx,ky,kz,echo,coil) volume as in load_h5_qdess()
+
+        keeps up to max_open file handles open across calls, closing the least 
+        recently used. slices are returned as in get_qdess_slice(), i.e. 
+        complex tensor dim (ne*nc,ky,kz) w echoes concatenated along coil dim '''
+
+    def __init__(self, path_in=PATH_QDESS, max_open=8):
+        self.path_in = path_in
+        self.max_open = max_open
+        self.files = OrderedDict()
+
+    def get_dset(self, file_id):
+        ''' return kspace dataset of file_id, opening the file if needed '''
+
+        if file_id in self.files:
+            self.files.move_to_end(file_id)
+        else:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            filename = '{}MTR_{}.h5'.format(self.path_in, file_id)
+            self.files[file_id] = h5py.File(filename, 'r')
+
+        try:
+            return self.files[file_id]['kspace']
+        except KeyError:
+            raise KeyError('No kspace in file {} w keys {}'.format(
+                            self.files[file_id].filename, list(self.files[file_id].keys())))
+
+    def get_shape(self, file_id):
+        ''' return shape of full ksp volume, i.e. (kx,ky,kz,echo,coil) '''
+        return self.get_dset(file_id).shape
+
+    def read_slice(self, file_id, idx_kx=None, echoes=(0,1)):
+        ''' return slice idx_kx dim (len(echoes)*nc,ky,kz). default central slice '''
+
+        dset = self.get_dset(file_id)
+        if idx_kx is None:
+            idx_kx = dset.shape[0] // 2
+
+        # hyperslab read of dim (ky,kz,echo,coil)
+        ksp = torch.from_numpy(dset[idx_kx, :, :, list(echoes), :])
+
+        # --> (echo,coil,ky,kz) --> concat echoes along coil dim
+        return ksp.permute(2,3,0,1).reshape(-1, *ksp.shape[:2])
+
+    def iter_slices(self, file_id, idx_kx_list=None, echoes=(0,1)):
+        ''' lazily yield (idx_kx, slice) for each slice. default all slices '''
+
+        if idx_kx_list is None:
+            idx_kx_list = range(self.get_shape(file_id)[0])
+        for idx_kx in idx_kx_list:
+            yield idx_kx, self.read_slice(file_id, idx_kx, echoes)
+
+    def close(self):
+        while self.files:
+            self.files.popitem()[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+_qdess_reader = None
+
+def get_qdess_reader():
+    ''' return module-level reader s.t. file handles persist across load_qdess() calls '''
+    global _qdess_reader
+    if _qdess_reader is None:
+        _qdess_reader = QDessReader()
+    return _qdess_reader
+
+########## cache of preprocessed qdess slices ##################################
+# each slice is stored as complex64 npy dim (2*nc,ky,kz), i.e. the output of
+# get_qdess_slice(), under {PATH_CACHE}v{CACHE_VERSION}/MTR_{id}/kx{idx}.npy
+# slices are memory-mapped on load s.t. concurrent workers share pages
+
+PATH_CACHE = '/bmrNAS/people/dvv/in_qdess/cache/'
+CACHE_VERSION = 1 # bump whenever slice preprocessing changes to invalidate cache
+
+def get_cache_dir(file_id, path_cache=PATH_CACHE):
+    return '{}v{}/MTR_{}/'.format(path_cache, CACHE_VERSION, file_id)
+
+def load_cached_slice(file_id, idx_kx=None, path_cache=PATH_CACHE):
+    ''' return cached slice idx_kx, or None if not cached. default central slice
+        array is mapped copy-on-write, i.e. pages are read lazily + shared '''
+
+    path_c = get_cache_dir(file_id, path_cache)
+
+    if idx_kx is None: # central slice requires volume shape, stored w first slice
+        if not os.path.exists(path_c + 'shape.npy'):
+            return None
+        idx_kx = int(np.load(path_c + 'shape.npy')[0]) // 2
+
+    fn = '{}kx{:03d}.npy'.format(path_c, idx_kx)
+    if not os.path.exists(fn):
+        return None
+
+    return torch.from_numpy(np.load(fn, mmap_mode='c'))
+
+def save_cached_slice(ksp, file_id, idx_kx, shape, path_cache=PATH_CACHE):
+    ''' add slice to cache, given ksp dim (2*nc,ky,kz) + shape of full volume '''
+
+    path_c = get_cache_dir(file_id, path_cache)
+    os.makedirs(path_c, exist_ok=True)
+
+    if idx_kx is None:
+        idx_kx = shape[0] // 2
+    if not os.path.exists(path_c + 'shape.npy'):
+        save_npy_atomic(path_c + 'shape.npy', np.array(shape))
+
+    save_npy_atomic('{}kx{:03d}.npy'.format(path_c, idx_kx),
+                    np.asarray(ksp).astype(np.complex64, copy=False))
+
+def save_npy_atomic(fn, arr):
+    ''' save arr to a tmp file, then rename s.t. readers never see a partial file '''
+
+    fn_tmp = '{}.tmp{}'.format(fn, os.getpid())
+    with open(fn_tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(fn_tmp, fn)
+
+def precompute_cache(file_id_list, idx_kx_list=None, path_cache=PATH_CACHE,
+                     overwrite=False):
+    ''' populate cache w slices idx_kx_list of each file. default all slices '''
+
+    reader = get_qdess_reader()
+
+    for file_id in file_id_list:
+
+        shape = reader.get_shape(file_id)
+        idx_list = range(shape[0]) if idx_kx_list is None else idx_kx_list
+        path_c = get_cache_dir(file_id, path_cache)
+
+        num_new = 0
+        for idx_kx in idx_list:
+            if not overwrite and os.path.exists('{}kx{:03d}.npy'.format(path_c, idx_kx)):
+                continue
+            save_cached_slice(reader.read_slice(file_id, idx_kx), file_id, idx_kx,
+                              shape, path_cache)
+            num_new += 1
+
+        reader.close()
+        print('cached MTR_{}: {} new slices in {}'.format(file_id, num_new, path_c))
+
 ########## semi-deprecated functions below #####################################
 
 def load_imgs_many_inits(mtr_id_list, path, num_inits=None, avg_inits=True):
@@ -156,3 +330,27 @@ def load_imgs_many_inits(mtr_id_list, path, num_inits=None, avg_inits=True):
         arr = np.mean(arr, axis=1)
 
     return arr
+
+if __name__ == '__main__':
+
+    # precompute slice cache, e.g. python -m utils.data_io --num_slices 32
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file_id_list', nargs='+', default=None) # default all files
+    parser.add_argument('--idx_kx_list', nargs='+', type=int, default=None) # default all slices
+    parser.add_argument('--num_slices', type=int, default=None) # ... or N slices around center
+    parser.add_argument('--path_cache', type=str, default=PATH_CACHE)
+    parser.add_argument('--overwrite', dest='overwrite', action='store_true')
+    parser.set_defaults(overwrite=False)
+    args = parser.parse_args()
+
+    if args.file_id_list is None:
+        args.file_id_list = get_mtr_ids(get_file_list(PATH_QDESS))
+
+    if args.num_slices is not None:
+        idx_center = get_qdess_reader().get_shape(args.file_id_list[0])[0] // 2
+        args.idx_kx_list = range(idx_center - args.num_slices // 2,
+                                 idx_center + (args.num_slices + 1) // 2)
+
+    precompute_cache(args.file_id_list, args.idx_kx_list, args.path_cache, args.overwrite)
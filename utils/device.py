@@ -0,0 +1,43 @@
+''' device and dtype selection shared by the convdecoder, fit, and run scripts '''
+
+import os
+import torch
+
+
+def get_dtype(device=None):
+    ''' return tensor type for a given device, e.g. torch.cuda.FloatTensor
+        default (device=None) is gpu if available, else cpu '''
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    return torch.cuda.FloatTensor if torch.device(device).type == 'cuda' \
+                                  else torch.FloatTensor
+
+def get_device(dtype):
+    ''' return torch.device matching a tensor type, e.g. torch.cuda.FloatTensor
+        used to move complex tensors, which can't be cast via .type(dtype) '''
+
+    return torch.device('cuda') if dtype.is_cuda else torch.device('cpu')
+
+def set_device(device=None, num_threads=None):
+    ''' configure execution for a run script, return dtype to pass downstream
+        device: e.g. 'cpu', 'cuda', 'cuda:2'. default gpu if available
+        num_threads: intra-op threads for cpu. default all available cores '''
+
+    dtype = get_dtype(device)
+
+    if dtype.is_cuda:
+        if device is not None and torch.device(device).index is not None:
+            torch.cuda.set_device(torch.device(device))
+        torch.backends.cudnn.benchmark = True
+    elif num_threads is None: # respect cpu affinity, e.g. slurm --cpus-per-task
+        num_threads = len(os.sched_getaffinity(0)) \
+                      if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    return dtype
+
+DEFAULT_DTYPE = get_dtype()
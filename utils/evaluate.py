@@ -1,21 +1,29 @@
 ''' various functions for computing image quality metrics '''
 
 import h5py
+import queue
 import scipy
+import pathlib
+import threading
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
 
 from runstats import Statistics
+from concurrent.futures import ThreadPoolExecutor
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity
-from pytorch_msssim import ms_ssim
 
-from utils.hfen import HFENLoss
-from utils.data_io import get_mtr_ids_and, load_imgs, load_imgs_many_inits
+from utils.hfen import get_hfen
+from utils.metrics import calc_metrics_batch, ms_ssim_batch
+from utils.metric_cache import MetricCache, calc_metrics_paths, get_cache_file
+from utils.data_io import get_mtr_ids_and
 
-def calc_metrics_imgs(imgs_gt, imgs_out):
+def calc_metrics_imgs(imgs_gt, imgs_out, batched=False):
     ''' given (gt, out) imgs over many qdess samples / echos
-        compute metrics for each '''
+        compute metrics for each
+        batched: if True, compute for all imgs at once via utils.metrics, which
+                 matches calc_metrics() up to roundoff. else loop over imgs, 
+                 which is faster on cpu, see calc_metrics* in bench/run_bench.py '''
     
     assert imgs_gt.shape == imgs_out.shape
     assert imgs_gt.shape[-2:] == (512, 160)
@@ -23,11 +31,17 @@ def calc_metrics_imgs(imgs_gt, imgs_out):
     
     num_samps = imgs_gt.shape[0]
     num_echos = imgs_gt.shape[1]
-    num_metrics = 5 # vif, msssim, ssim, psnr
+    num_metrics = 5 # vif, msssim, ssim, psnr, hfen
     
+    hfen = get_hfen()
+
+    if batched:
+        metrics = calc_metrics_batch(imgs_gt.reshape(-1, 512, 160),
+                                     imgs_out.reshape(-1, 512, 160), hfen)
+        metrics = metrics.reshape(num_samps, num_echos, num_metrics)
+        return np.around(metrics, decimals=4)
+
     metrics = np.empty((num_samps, num_echos, num_metrics))
-    
-    hfen = HFENLoss()
 
     for idx_s in np.arange(num_samps):
         for idx_e in np.arange(num_echos):
@@ -39,9 +53,9 @@ def calc_metrics_imgs(imgs_gt, imgs_out):
 
 def calc_metrics(img_gt, img_out, hfen):
     ''' compute vif, mssim, ssim, and psnr of img_out using img_gt as ground-truth reference 
-        note: for msssim, made a slight mod to source code in line 200 of 
-              /home/vanveen/heck/lib/python3.8/site-packages/pytorch_msssim/ssim.py 
-              to compute msssim over images w smallest dim >=160 '''
+        note: msssim via utils.metrics.ms_ssim_batch, i.e. pytorch_msssim.ms_ssim
+              w/o its assert on imgs w smallest dim <=160, s.t. stock
+              pytorch_msssim isn't patched to compute msssim over 512x160 imgs '''
 
     img_gt, img_out = norm_imgs(img_gt, img_out)
     img_gt, img_out = np.array(img_gt), np.array(img_out)
@@ -52,7 +66,8 @@ def calc_metrics(img_gt, img_out, hfen):
 
     img_out_ = torch.from_numpy(np.array([[img_out]]))
     img_gt_ = torch.from_numpy(np.array([[img_gt]]))
-    msssim_ = float(ms_ssim(img_out_, img_gt_, data_range=img_gt_.max()))
+    msssim_ = float(ms_ssim_batch(img_out_[0], img_gt_[0],
+                                  data_range=img_gt_.max().reshape(1, 1, 1)))
 
     hfen_ = 10000 * float(hfen(img_gt_.float(), img_out_.float()))
 
@@ -190,12 +205,13 @@ class Metrics:
     """
 
     def __init__(self, metric_funcs):
+        self.metric_funcs = metric_funcs
         self.metrics = {
             metric: Statistics() for metric in metric_funcs
         }
 
     def push(self, target, recons):
-        for metric, func in METRIC_FUNCS.items():
+        for metric, func in self.metric_funcs.items():
             self.metrics[metric].push(func(target, recons))
 
     def means(self):
@@ -217,42 +233,115 @@ class Metrics:
         )
 
 
-def evaluate(args, recons_key):
-    metrics = Metrics(METRIC_FUNCS)
+def evaluate(args, recons_key, num_workers=4, prefetch=16):
+    ''' metrics of each slice of recons in args.predictions_path w.r.t. the
+        target files of the same name in args.target_path, as in fastmri
+        slices are streamed via iter_slices(), s.t. memory is bounded for any
+        num of files. returns dict acquisition --> Metrics, plus 'all' over
+        all slices, e.g. print('{}: {}'.format(acq, metrics[acq]))
+
+        NOTE: each metric is computed per slice, i.e. means + stddevs are over
+              slices, not over volumes as in fastmri's evaluate.py, which
+              computes each metric on a whole volume. values therefore differ
+              from fastmri's, e.g. psnr uses the max of each slice, not of the
+              volume, + volumes w more slices have more weight '''
+
+    metrics = {'all': Metrics(METRIC_FUNCS)}
+
+    for acquisition, target, recons in iter_slices(args.target_path,
+            args.predictions_path, recons_key, args.acquisition, num_workers, prefetch):
+        if acquisition not in metrics:
+            metrics[acquisition] = Metrics(METRIC_FUNCS)
+        metrics['all'].push(target, recons)
+        metrics[acquisition].push(target, recons)
 
-    for tgt_file in args.target_path.iterdir():
-        with h5py.File(tgt_file) as target, h5py.File(
-          args.predictions_path / tgt_file.name) as recons:
-            if args.acquisition and args.acquisition != target.attrs['acquisition']:
-                continue
-            target = target[recons_key].value
-            recons = recons['reconstruction'].value
-            metrics.push(target, recons)
     return metrics
 
-def get_mu_diff(path_gt, path_bl, path_new, inits_bl=None, inits_new=None):
-    ''' get diff in metrics between two paths '''
+def iter_slices(target_path, predictions_path, recons_key, acquisition=None,
+                num_workers=4, prefetch=16):
+    ''' yield (acquisition, target, recons) for each slice of each target file
+        w a recon of the same name in predictions_path. files are read slice by
+        slice in a pool of num_workers threads, s.t. reads overlap computation
+        on the slices yielded. at most prefetch slices are read ahead
+        acquisition: if given, skip files of any other acquisition
+        target files w/o a recon are skipped
+        NOTE: slices of different files are interleaved '''
+
+    target_path, predictions_path = pathlib.Path(target_path), pathlib.Path(predictions_path)
+    tgt_files = sorted(target_path.iterdir())
+    missing = [f for f in tgt_files if not (predictions_path / f.name).exists()]
+    if missing:
+        print('skipping {} of {} targets w/o a recon in {}, e.g. {}'.format(
+                len(missing), len(tgt_files), predictions_path, missing[0].name))
+        tgt_files = [f for f in tgt_files if f not in missing]
+
+    slices = queue.Queue(maxsize=prefetch)
+    stop = threading.Event() # set once consumer exits, s.t. readers don't block
+    done = object() # put by each reader when finished
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                slices.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_file(tgt_file):
+        try:
+            if stop.is_set():
+                return
+            with h5py.File(tgt_file, 'r') as target, \
+                 h5py.File(predictions_path / tgt_file.name, 'r') as recons:
+                acq = target.attrs.get('acquisition')
+                if acquisition and acquisition != acq:
+                    return
+                for idx in range(target[recons_key].shape[0]):
+                    if not put((acq, target[recons_key][idx],
+                                recons['reconstruction'][idx])):
+                        return
+        except Exception as e: # re-raised by consumer
+            put(e)
+        finally:
+            put(done)
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        for tgt_file in tgt_files:
+            pool.submit(read_file, tgt_file)
+        try:
+            num_done = 0
+            while num_done < len(tgt_files):
+                item = slices.get()
+                if item is done:
+                    num_done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+def get_mu_diff(path_gt, path_bl, path_new, inits_bl=None, inits_new=None,
+                cache=False, num_workers=None):
+    ''' get diff in metrics between two paths, evaluated in a process pool of
+        num_workers
+        cache: if True, cache metrics of each recon by file contents in a db in
+               path_gt, s.t. only new or changed recons are evaluated. or path
+               of the db. see utils.metric_cache '''
     
     mtr_id_list = get_mtr_ids_and(path_bl, path_new)
 
-    imgs_gt = load_imgs(mtr_id_list, path=path_gt)
-    
-    if 'many_inits' in path_bl:
-        imgs_bl = load_imgs_many_inits(mtr_id_list, path_bl, 
-                                        num_inits=inits_bl,
-                                        avg_inits=True)
+    if cache:
+        cache = MetricCache(get_cache_file(path_gt) if cache is True else cache)
     else:
-        imgs_bl = load_imgs(mtr_id_list, path=path_bl)
-    
-    if 'many_inits' in path_new:
-        imgs_new = load_imgs_many_inits(mtr_id_list, path_new, 
-                                        num_inits=inits_new,
-                                        avg_inits=True)
-    else:
-        imgs_new = load_imgs(mtr_id_list, path=path_new)
-
-    metrics_bl = calc_metrics_imgs(imgs_gt, imgs_bl)
-    metrics_new = calc_metrics_imgs(imgs_gt, imgs_new)
+        cache = None
+    metrics_bl = calc_metrics_paths(mtr_id_list, path_gt, path_bl, inits_bl,
+                                    cache, num_workers)
+    metrics_new = calc_metrics_paths(mtr_id_list, path_gt, path_new, inits_new,
+                                     cache, num_workers)
+    if cache is not None:
+        cache.close()
     
     mu_bl = np.around(np.mean(metrics_bl, 0), 4)
     mu_new = np.around(np.mean(metrics_new, 0), 4)
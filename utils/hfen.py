@@ -4,6 +4,11 @@ import os, sys
 import torch
 import torch.nn as nn
 import math, numbers
+import scipy.fft
+
+# kernels at least this large are applied as fft convolutions, see apply_filter()
+# on cpu, fft is ~4x faster than conv2d for the 15x15 LoG on 512x160 imgs
+FFT_MIN_KERNEL_SIZE = 7
 
 class HFENLoss(nn.Module): # Edge loss with pre_smooth
     """Calculates high frequency error norm (HFEN) between target and
@@ -28,8 +33,10 @@ class HFENLoss(nn.Module): # Edge loss with pre_smooth
         Target image
     norm: if true, follows [2], who define a normalized version of HFEN.
         If using RelativeL1 criterion, it's already normalized.
+    fft: if true, apply the kernel as an fft convolution, which matches
+        self.filter up to float roundoff. default for kernel_size >= FFT_MIN_KERNEL_SIZE
     """
-    def __init__(self, loss_f=torch.nn.MSELoss(), kernel='log', kernel_size=15, sigma = 2.5, norm = True): #1.4 ~ 1.5
+    def __init__(self, loss_f=torch.nn.MSELoss(), kernel='log', kernel_size=15, sigma = 2.5, norm = True, fft=None): #1.4 ~ 1.5
         super(HFENLoss, self).__init__()
         # can use different criteria
         self.criterion = loss_f
@@ -40,17 +47,67 @@ class HFENLoss(nn.Module): # Edge loss with pre_smooth
         else:
             kernel = get_log_kernel(kernel_size, sigma)
         self.filter = load_filter(kernel=kernel, kernel_size=kernel_size)
+        self.fft = kernel_size >= FFT_MIN_KERNEL_SIZE if fft is None else fft
+        self.kernel_f = {} # (fft size, device, dtype) --> fft of kernel
 
     def forward(self, img1, img2):
-        self.filter.to(img1.device)
         # HFEN loss
-        log1 = self.filter(img1)
-        log2 = self.filter(img2)
+        log1 = self.apply_filter(img1)
+        log2 = self.apply_filter(img2)
         hfen_loss = self.criterion(log1, log2)
         if self.norm:
             hfen_loss /= img2.norm()
         return hfen_loss
 
+    def forward_batch(self, img1, img2):
+        ''' hfen of each img in img1, img2 dim [n,1,x,y], as forward() applied to
+            each img separately, i.e. w per-img norm. returns tensor [n] '''
+
+        log1 = self.apply_filter(img1)
+        log2 = self.apply_filter(img2)
+        if isinstance(self.criterion, nn.MSELoss):
+            hfen_loss = ((log1 - log2) ** 2).flatten(1).mean(dim=1)
+        else:
+            hfen_loss = torch.stack([self.criterion(l1, l2) for l1, l2 in zip(log1, log2)])
+        if self.norm:
+            hfen_loss = hfen_loss / img2.flatten(1).norm(dim=1)
+        return hfen_loss
+
+    def apply_filter(self, imgs):
+        ''' apply self.filter to imgs dim [n,1,x,y], either as conv2d or as fft
+            convolution w the kernel's fft cached per img size, device, dtype '''
+
+        self.filter.to(imgs.device)
+        if not self.fft:
+            return self.filter(imgs)
+
+        # conv2d is a correlation, i.e. a convolution w the flipped kernel
+        # zero pad as the conv layer. full linear convolution fits in (mx, my)
+        kernel = self.filter.weight
+        (px, py), (kx, ky) = self.filter.padding, kernel.shape[-2:]
+        nx, ny = imgs.shape[-2] + 2 * px, imgs.shape[-1] + 2 * py
+        mx, my = scipy.fft.next_fast_len(nx, real=True), scipy.fft.next_fast_len(ny, real=True)
+
+        key = (mx, my, imgs.device, imgs.dtype)
+        if key not in self.kernel_f:
+            self.kernel_f[key] = torch.fft.rfft2(kernel[:, 0].detach().flip(-2, -1).to(imgs),
+                                                 s=(mx, my)) # one kernel per channel
+
+        imgs_f = torch.fft.rfft2(nn.functional.pad(imgs, (py, py, px, px)), s=(mx, my))
+        imgs = torch.fft.irfft2(imgs_f * self.kernel_f[key], s=(mx, my))
+
+        return imgs[..., kx-1:nx, ky-1:ny]
+
+_hfen = None
+
+def get_hfen():
+    ''' return module-level HFENLoss s.t. its filter + cached kernel fft persist
+        across calls, e.g. to monitor hfen during fit() '''
+    global _hfen
+    if _hfen is None:
+        _hfen = HFENLoss()
+    return _hfen
+
 def get_log_kernel_5x5():
     '''
     This is a precomputed LoG kernel that has already been convolved with
@@ -158,8 +215,10 @@ def load_filter(kernel, kernel_size=3, in_channels=1, out_channels=1,
             Received {}.'.format(dim)
         )
 
+    # note: padding=True, i.e. 1, is passed rather than pad. kept s.t. hfen is
+    # comparable to earlier results. int() as newer torch rejects bool padding
     filter = conv(in_channels=in_channels, out_channels=out_channels,
-                        kernel_size=kernel_size, stride=stride, padding=padding,
+                        kernel_size=kernel_size, stride=stride, padding=int(padding),
                         groups=groups, bias=False)
     filter.weight.data = kernel
     filter.weight.requires_grad = requires_grad
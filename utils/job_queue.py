@@ -0,0 +1,211 @@
+''' sqlite work queue s.t. several workers, e.g. slurm array tasks, can share a sweep
+
+    each job is a dict of params, e.g. {'expmt': 'run_qdess', 'file_id': '005',
+    'accel': 4, 'config': 'dir_out'}, stored once in a manifest table. workers
+    claim jobs atomically, so no job runs twice concurrently, and a job is only
+    marked done after its outputs are saved. a worker renews the lease of its job
+    while running it, s.t. jobs of crashed workers are reclaimed once their lease 
+    expires, and re-launching a sweep resumes it. done jobs whose outputs are
+    missing are re-run if add() is passed an is_done check
+
+    note: sqlite relies on posix file locks, so the db must live on a
+    filesystem which supports them '''
+
+import os
+import json
+import contextlib
+import time
+import socket
+import sqlite3
+import threading
+import traceback
+
+TODO, RUNNING, DONE, FAILED = 'todo', 'running', 'done', 'failed'
+
+
+class JobQueue():
+
+    def __init__(self, filename, lease=600, max_attempts=3):
+        ''' filename: path to sqlite db, created if dne
+            lease: seconds w/o renewal after which a running job is presumed dead
+                   + reclaimed. renewed every lease/4 sec while a job runs
+            max_attempts: number of times a job is tried before marked failed '''
+
+        self.filename = filename
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        # autocommit mode, s.t. transactions are managed explicitly below
+        self.conn = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                id INTEGER PRIMARY KEY,
+                                params TEXT UNIQUE NOT NULL,
+                                status TEXT NOT NULL DEFAULT '{}',
+                                worker TEXT,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                lease_until REAL,
+                                error TEXT)'''.format(TODO))
+
+    def add(self, params_list, is_done=None):
+        ''' add jobs to manifest, ignoring any already present
+            is_done: optional func(params) --> bool, e.g. whether a job's outputs
+                     exist. jobs of params_list marked done for which it returns
+                     False, e.g. b/c their outputs were deleted, are set back to
+                     todo w their attempts reset
+            returns num jobs added or set back to todo '''
+
+        rows = [(json.dumps(params, sort_keys=True),) for params in params_list]
+        with self.transaction():
+            num_before = self.count()
+            self.conn.executemany('INSERT OR IGNORE INTO jobs (params) VALUES (?)', rows)
+            num_added = self.count() - num_before
+
+        if is_done is None:
+            return num_added
+
+        # check outputs outside of a transaction, as it may be slow on a nas
+        keys = set(row[0] for row in rows)
+        done = self.conn.execute('SELECT id, params FROM jobs WHERE status = ?',
+                                 (DONE,)).fetchall()
+        redo = [(TODO, job_id, DONE) for job_id, params in done \
+                if params in keys and not is_done(json.loads(params))]
+        with self.transaction():
+            self.conn.executemany('''UPDATE jobs SET status = ?, attempts = 0, error = NULL
+                                     WHERE id = ? AND status = ?''', redo)
+
+        return num_added + len(redo)
+
+    def claim(self):
+        ''' atomically claim next job which is todo, or whose lease has expired
+            returns (job_id, params), or None if no jobs are left
+            expired jobs w/o attempts left are marked failed, not reclaimed '''
+
+        now = time.time()
+        with self.transaction():
+            self.conn.execute(
+                    '''UPDATE jobs SET status = ?, error = 'lease expired' WHERE
+                       status = ? AND lease_until < ? AND attempts >= ?''',
+                    (FAILED, RUNNING, now, self.max_attempts))
+            row = self.conn.execute(
+                    '''SELECT id, params FROM jobs WHERE attempts < ? AND
+                       (status = ? OR (status = ? AND lease_until < ?))
+                       ORDER BY id LIMIT 1''',
+                    (self.max_attempts, TODO, RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                    '''UPDATE jobs SET status = ?, worker = ?, lease_until = ?,
+                       attempts = attempts + 1 WHERE id = ?''',
+                    (RUNNING, self.worker, now + self.lease, row[0]))
+
+        return row[0], json.loads(row[1])
+
+    # complete(), fail(), release() only apply if this worker still holds the job,
+    # i.e. not if its lease expired + the job was reclaimed by another worker
+
+    def complete(self, job_id):
+        self.conn.execute('''UPDATE jobs SET status = ?, error = NULL 
+                             WHERE id = ? AND worker = ?''', (DONE, job_id, self.worker))
+
+    def fail(self, job_id, error):
+        ''' release job for retry, or mark failed once out of attempts '''
+        self.conn.execute(
+                '''UPDATE jobs SET error = ?, status = CASE WHEN attempts < ?
+                   THEN ? ELSE ? END WHERE id = ? AND worker = ?''',
+                (error, self.max_attempts, TODO, FAILED, job_id, self.worker))
+
+    def run(self, func):
+        ''' claim + run jobs until none are left, calling func(params) for each
+            a job raising an exception is marked failed for retry, and the next job
+            is run. SystemExit (e.g. fit() preempted) or KeyboardInterrupt release
+            the job w/o using up an attempt, then are re-raised '''
+
+        while True:
+            job = self.claim()
+            if job is None:
+                return
+            job_id, params = job
+            try:
+                with self.heartbeat(job_id):
+                    func(params)
+            except Exception as e:
+                traceback.print_exc()
+                self.fail(job_id, repr(e))
+                continue
+            except BaseException:
+                self.release(job_id)
+                raise
+            self.complete(job_id)
+
+    def renew(self, job_id, conn=None):
+        ''' extend lease of job held by this worker. returns False if no longer held '''
+        conn = conn or self.conn
+        cur = conn.execute('''UPDATE jobs SET lease_until = ? WHERE id = ? AND
+                              worker = ? AND status = ?''',
+                           (time.time() + self.lease, job_id, self.worker, RUNNING))
+        return cur.rowcount > 0
+
+    @contextlib.contextmanager
+    def heartbeat(self, job_id):
+        ''' renew lease of job every lease/4 sec in a background thread while in
+            context. thread uses its own connection, as sqlite connections 
+            can't be shared across threads '''
+
+        stop = threading.Event()
+
+        def beat():
+            conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            try:
+                while not stop.wait(self.lease / 4):
+                    try:
+                        self.renew(job_id, conn)
+                    except sqlite3.Error as e: # e.g. db locked, retry next beat
+                        print('lease renewal of job {} failed: {!r}'.format(job_id, e))
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, job_id):
+        ''' return job to todo w/o using up an attempt, e.g. to resume from checkpoint '''
+        self.conn.execute(
+                '''UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0)
+                   WHERE id = ? AND worker = ?''', (TODO, job_id, self.worker))
+
+    def reset_failed(self):
+        ''' give failed jobs another max_attempts tries '''
+        self.conn.execute('UPDATE jobs SET status = ?, attempts = 0 WHERE status = ?',
+                          (TODO, FAILED))
+
+    def count(self, status=None):
+        if status is None:
+            return self.conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM jobs WHERE status = ?',
+                                 (status,)).fetchone()[0]
+
+    def summary(self):
+        ''' return dict status --> num jobs '''
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        ''' BEGIN IMMEDIATE takes the db write lock up front, s.t. the select +
+            update in claim() can't interleave w another worker's '''
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def close(self):
+        self.conn.close()
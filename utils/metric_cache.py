@@ -0,0 +1,154 @@
+''' cache of per-img metrics keyed by (hash of gt file contents, hash of recon 
+    file contents, METRIC_VERSION), s.t. comparing a new run against existing 
+    baselines only computes metrics of recons which are new or have changed
+
+    cache misses are computed in a process pool, in chunks of imgs via
+    utils.evaluate.calc_metrics(). like utils.job_queue, the cache is an
+    sqlite db, s.t. concurrent evaluations can share it '''
+
+import os
+import json
+import hashlib
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+
+from utils.metrics import METRIC_VERSION
+from utils.hfen import get_hfen
+
+
+
+class MetricCache():
+
+    def __init__(self, filename):
+        ''' filename: path to sqlite db, created if dne. see get_cache_file() '''
+
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=60)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS metrics (
+                                    gt_hash TEXT NOT NULL,
+                                    recon_hash TEXT NOT NULL,
+                                    version INTEGER NOT NULL,
+                                    metrics TEXT NOT NULL,
+                                    PRIMARY KEY (gt_hash, recon_hash, version))''')
+
+    def get(self, keys):
+        ''' return dict key --> np array of metrics, for keys which are cached '''
+
+        cached = {}
+        for key in keys:
+            row = self.conn.execute('''SELECT metrics FROM metrics WHERE gt_hash = ? AND
+                                       recon_hash = ? AND version = ?''', key).fetchone()
+            if row is not None:
+                cached[key] = np.array(json.loads(row[0]))
+
+        return cached
+
+    def put(self, metrics):
+        ''' metrics: dict key --> np array of metrics '''
+
+        rows = [(*key, json.dumps(m.tolist())) for key, m in metrics.items()]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.conn.close()
+
+def get_cache_file(path_gt):
+    ''' default cache db, next to the gt imgs it's keyed by '''
+    return os.path.join(path_gt, 'metric_cache.db')
+
+def calc_metrics_paths(mtr_id_list, path_gt, path, num_inits=None, cache=None,
+                       num_workers=None):
+    ''' equivalent of calc_metrics_imgs(load_imgs(.., path_gt), load_imgs(.., path))
+        for recons in path, w the mean over inits if a many_inits path
+        returns np array [num_samps, num_echos, num_metrics] '''
+
+    pairs = []
+    for mtr_id in mtr_id_list:
+        for echo in ['e1', 'e2']:
+            fn_gt = '{}MTR_{}_{}_gt.npy'.format(path_gt, mtr_id, echo)
+            if 'many_inits' in path:
+                fn_list = ['{}MTR_{}_{}_init{}.npy'.format(path, mtr_id, echo, idx_i) \
+                           for idx_i in range(num_inits or 4)]
+            else:
+                fn_list = ['{}MTR_{}_{}.npy'.format(path, mtr_id, echo)]
+            pairs.append((fn_gt, fn_list))
+
+    metrics = calc_metrics_files(pairs, cache, num_workers)
+
+    return np.around(metrics.reshape(len(mtr_id_list), 2, -1), decimals=4)
+
+def calc_metrics_files(pairs, cache=None, num_workers=None, chunk_size=8):
+    ''' pairs: list of (gt filename, list of recon filenames), where the recon
+               img is the mean over the list, e.g. over inits
+        cache: MetricCache, or None to compute all
+        returns np array [num_pairs, num_metrics] '''
+
+    # hash each gt once, e.g. if compared against several recons
+    gt_hashes = {fn_gt: get_file_hash([fn_gt]) \
+                 for fn_gt in set(fn_gt for fn_gt, _ in pairs)}
+    keys = [(gt_hashes[fn_gt], get_file_hash(fn_list), METRIC_VERSION) \
+            for fn_gt, fn_list in pairs]
+    metrics = cache.get(set(keys)) if cache is not None else {}
+
+    # each key once, e.g. if a recon is evaluated in several comparisons
+    todo = {}
+    for key, pair in zip(keys, pairs):
+        if key not in metrics:
+            todo[key] = pair
+    todo = list(todo.items())
+    chunks = [todo[idx:idx+chunk_size] for idx in range(0, len(todo), chunk_size)]
+    chunk_pairs = [[pair for _, pair in chunk] for chunk in chunks]
+
+    if num_workers is None:
+        num_workers = len(os.sched_getaffinity(0)) \
+                      if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    num_workers = min(num_workers, len(chunks))
+
+    if num_workers > 1:
+        # spawn, as forking after torch has started its thread pool can deadlock
+        # one thread per worker, as workers already occupy all cores
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=torch.set_num_threads,
+                                 initargs=(1,)) as executor:
+            results = list(executor.map(_calc_metrics_chunk, chunk_pairs))
+    else:
+        results = [_calc_metrics_chunk(chunk) for chunk in chunk_pairs]
+
+    computed = {}
+    for chunk, result in zip(chunks, results):
+        for (key, _), m in zip(chunk, result):
+            computed[key] = m
+    if cache is not None and computed:
+        cache.put(computed)
+    metrics.update(computed)
+
+    return np.stack([metrics[key] for key in keys])
+
+def _calc_metrics_chunk(pairs):
+    ''' worker for calc_metrics_files(), must be top-level to be pickled '''
+
+    from utils.evaluate import calc_metrics # utils.evaluate imports this module
+
+    # float64 before averaging, as load_imgs(), load_imgs_many_inits()
+    imgs_gt = np.stack([np.load(fn_gt).astype(np.float64) for fn_gt, _ in pairs])
+    imgs_out = np.stack([np.mean([np.load(fn).astype(np.float64) for fn in fn_list],
+                                 axis=0) for _, fn_list in pairs])
+
+    return np.array([calc_metrics(img_gt, img_out, get_hfen()) \
+                     for img_gt, img_out in zip(imgs_gt, imgs_out)])
+
+def get_file_hash(fn_list):
+    ''' sha1 of contents of all files in list '''
+
+    sha1 = hashlib.sha1()
+    for fn in fn_list:
+        with open(fn, 'rb') as f:
+            sha1.update(f.read())
+
+    return sha1.hexdigest()
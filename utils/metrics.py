@@ -0,0 +1,264 @@
+''' batched image quality metrics, i.e. vif, ms-ssim, ssim, psnr, hfen of a whole
+    stack of imgs in a few tensor ops, rather than a python loop over imgs
+
+    each function takes (gt, out) imgs dim [n,x,y] as float64 tensors and
+    returns a tensor [n] of per-img values, which match the per-img reference
+    implementations in utils.evaluate, i.e. skimage, pytorch_msssim, and the
+    numpy vif, up to floating point roundoff
+
+    gaussian filters run as fft convolutions, which on cpu are several times
+    faster than conv2d in float64, box filters as running sums '''
+
+import numpy as np
+import scipy.fft
+import torch
+import torch.nn.functional as F
+
+from utils.hfen import get_hfen
+
+METRIC_NAMES = ['vif', 'msssim', 'ssim', 'psnr', 'hfen'] # order of calc_metrics()
+METRIC_VERSION = 2 # bump on any change to metric values, invalidates utils.metric_cache
+MSSSIM_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+
+def calc_metrics_batch(imgs_gt, imgs_out, hfen=None, batch_size=8):
+    ''' batched equivalent of evaluate.calc_metrics() for imgs dim [n,x,y]
+        returns np array [n, 5] of vif, msssim, ssim, psnr, hfen per img
+        hfen: HFENLoss instance. default the shared one from utils.hfen.get_hfen()
+        batch_size: num imgs processed at once. larger batches spill out of 
+                    cache, which on cpu costs more than the per-call overhead '''
+
+    imgs_gt = torch.as_tensor(np.asarray(imgs_gt), dtype=torch.float64)
+    imgs_out = torch.as_tensor(np.asarray(imgs_out), dtype=torch.float64)
+    assert imgs_gt.shape == imgs_out.shape and imgs_gt.ndim == 3
+
+    if hfen is None:
+        hfen = get_hfen()
+
+    metrics = []
+    for idx in range(0, imgs_gt.shape[0], batch_size):
+        gt, out = norm_imgs_batch(imgs_gt[idx:idx+batch_size],
+                                  imgs_out[idx:idx+batch_size])
+        metrics.append(torch.stack([
+                vifp_mscale_batch(gt, out, sigma_nsq=_reduce(out, torch.mean)),
+                ms_ssim_batch(out, gt, data_range=_reduce(gt, torch.amax)),
+                ssim_batch(gt, out, data_range=_reduce(out, torch.amax)),
+                psnr_batch(gt, out, data_range=_reduce(gt, torch.amax)),
+                10000 * hfen_batch(gt, out, hfen)], dim=1))
+
+    return torch.cat(metrics).numpy()
+
+def _reduce(imgs, func):
+    ''' apply reduction func over img dims, keep them for broadcasting '''
+    return func(imgs, dim=(-2,-1), keepdim=True)
+
+def norm_imgs_batch(imgs_gt, imgs_out):
+    ''' batched evaluate.norm_imgs(), i.e. scale each gt to [0,.1], then match
+        mean + std of each out to its gt '''
+
+    mu, sig = _reduce(imgs_gt, torch.mean), _reduce(imgs_gt, _std)
+    C = .1 / _reduce(imgs_gt, torch.amax)
+    imgs_gt = (imgs_gt - mu) / sig
+    imgs_gt = imgs_gt * (C*sig)
+    imgs_gt = imgs_gt + (C*mu)
+
+    imgs_out = (imgs_out - _reduce(imgs_out, torch.mean)) / _reduce(imgs_out, _std)
+    imgs_out = imgs_out * _reduce(imgs_gt, _std)
+    imgs_out = imgs_out + _reduce(imgs_gt, torch.mean)
+
+    return imgs_gt, imgs_out
+
+def _std(imgs, dim, keepdim):
+    ''' population std, as np.std '''
+    return torch.std(imgs, dim=dim, keepdim=keepdim, unbiased=False)
+
+def psnr_batch(gt, pred, data_range):
+    ''' as skimage peak_signal_noise_ratio '''
+
+    err = ((gt - pred) ** 2).mean(dim=(-2,-1))
+    return 10 * torch.log10(data_range.flatten() ** 2 / err)
+
+def ssim_batch(gt, pred, data_range, win_size=7, K1=0.01, K2=0.03):
+    ''' as skimage structural_similarity w default args, i.e. uniform 7x7 window
+        w sample covariance. skimage averages over the img cropped by the window
+        radius, where its reflect-padded filter equals an unpadded one '''
+
+    NP = win_size ** 2
+    cov_norm = NP / (NP - 1)
+
+    ux, uy, uxx, uyy, uxy = box_filter(
+            torch.stack([gt, pred, gt * gt, pred * pred, gt * pred]), win_size)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    R = data_range
+    C1, C2 = (K1 * R) ** 2, (K2 * R) ** 2
+    A1, A2 = 2 * ux * uy + C1, 2 * vxy + C2
+    B1, B2 = ux ** 2 + uy ** 2 + C1, vx + vy + C2
+    S = (A1 * A2) / (B1 * B2)
+
+    return S.mean(dim=(-2,-1))
+
+def ms_ssim_batch(X, Y, data_range, win_size=11, win_sigma=1.5, K=(0.01, 0.03)):
+    ''' as pytorch_msssim.ms_ssim w default args, but per img data_range + w/o
+        its min img size assert. at levels where a dim is smaller than the
+        window, smoothing along that dim is skipped, as in pytorch_msssim '''
+
+    # window computed in float32, as in pytorch_msssim
+    coords = torch.arange(win_size, dtype=torch.float) - win_size // 2
+    win = torch.exp(-(coords ** 2) / (2 * win_sigma ** 2))
+    win = (win / win.sum()).to(X.dtype)
+
+    K1, K2 = K
+    C1 = (K1 * data_range[:, None]) ** 2 # [n,1,1,1] to broadcast over [n,1,x,y]
+    C2 = (K2 * data_range[:, None]) ** 2
+    X, Y = X[:, None], Y[:, None]
+
+    mcs = []
+    for level in range(len(MSSSIM_WEIGHTS)):
+        stack = torch.cat([X, Y, X * X, Y * Y, X * Y], dim=1)
+        mu1, mu2, xx, yy, xy = filter_sep(stack, win).unbind(1)
+        mu1_sq, mu2_sq, mu1_mu2 = mu1.pow(2), mu2.pow(2), mu1 * mu2
+        sigma1_sq, sigma2_sq, sigma12 = xx - mu1_sq, yy - mu2_sq, xy - mu1_mu2
+
+        cs_map = (2 * sigma12 + C2[:, 0]) / (sigma1_sq + sigma2_sq + C2[:, 0])
+        ssim_map = ((2 * mu1_mu2 + C1[:, 0]) / (mu1_sq + mu2_sq + C1[:, 0])) * cs_map
+
+        if level < len(MSSSIM_WEIGHTS) - 1:
+            mcs.append(torch.relu(cs_map.flatten(1).mean(-1)))
+            padding = [s % 2 for s in X.shape[2:]]
+            X = F.avg_pool2d(X, kernel_size=2, padding=padding)
+            Y = F.avg_pool2d(Y, kernel_size=2, padding=padding)
+
+    mcs_and_ssim = torch.stack(mcs + [torch.relu(ssim_map.flatten(1).mean(-1))])
+    weights = X.new_tensor(MSSSIM_WEIGHTS)
+
+    return torch.prod(mcs_and_ssim ** weights[:, None], dim=0)
+
+def vifp_mscale_batch(ref, dist, sigma_nsq, eps=1e-10):
+    ''' as evaluate.vifp_mscale, w sigma_nsq [n,1,1] per img '''
+
+    num, den = 0., 0.
+    for scale in range(1, 5):
+
+        N = 2**(4-scale+1) + 1
+        sd = N/5.0
+
+        if (scale > 1):
+            ref = gaussian_filter_batch(ref, sd)[:, ::2, ::2]
+            dist = gaussian_filter_batch(dist, sd)[:, ::2, ::2]
+
+        mu1, mu2, ref_sq, dist_sq, ref_dist = gaussian_filter_batch(
+                torch.stack([ref, dist, ref * ref, dist * dist, ref * dist]), sd)
+        mu1_sq = mu1 * mu1
+        mu2_sq = mu2 * mu2
+        mu1_mu2 = mu1 * mu2
+        sigma1_sq = ref_sq - mu1_sq
+        sigma2_sq = dist_sq - mu2_sq
+        sigma12 = ref_dist - mu1_mu2
+
+        # same sequence of masked assignments as the numpy version, in place
+        sigma1_sq.clamp_(min=0)
+        sigma2_sq.clamp_(min=0)
+
+        g = sigma12 / (sigma1_sq + eps)
+        sv_sq = sigma2_sq - g * sigma12
+
+        mask = sigma1_sq < eps
+        g.masked_fill_(mask, 0)
+        sv_sq = torch.where(mask, sigma2_sq, sv_sq)
+        sigma1_sq.masked_fill_(mask, 0)
+
+        mask = sigma2_sq < eps
+        g.masked_fill_(mask, 0)
+        sv_sq.masked_fill_(mask, 0)
+
+        mask = g < 0
+        sv_sq = torch.where(mask, sigma2_sq, sv_sq)
+        g.masked_fill_(mask, 0)
+        sv_sq.clamp_(min=eps)
+
+        num = num + torch.log10(1 + g * g * sigma1_sq / (sv_sq + sigma_nsq)).sum(dim=(-2,-1))
+        den = den + torch.log10(1 + sigma1_sq / sigma_nsq).sum(dim=(-2,-1))
+
+    return num / den
+
+def gaussian_filter_batch(imgs, sigma, truncate=4.0):
+    ''' as scipy.ndimage.gaussian_filter w default mode='reflect' applied to each
+        img of imgs [...,x,y] separately '''
+
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    win = torch.exp(-0.5 / sigma**2 * x**2)
+    win = (win / win.sum()).to(imgs.dtype)
+
+    return filter_sep(imgs, win, pad=True)
+
+def filter_sep(imgs, win, pad=False):
+    ''' filter last two dims of imgs [...,x,y] w a symmetric 1D window along each,
+        as one 2D fft convolution w the outer product of the window's ffts
+        pad: if True, pad as scipy.ndimage's reflect mode s.t. output size is
+             unchanged. else return the valid part only, i.e. w/o padding
+        dims shorter than the window are skipped, as in pytorch_msssim '''
+
+    r = len(win) // 2
+    if pad:
+        imgs = _pad_reflect(_pad_reflect(imgs, r, -2), r, -1)
+    nx, ny = imgs.shape[-2:]
+    skip_x, skip_y = nx < len(win), ny < len(win)
+
+    # circular convolution w window centered at 0. output w/o wrap-around
+    # is [r, n-r) along each dim, which is all that's kept
+    # zero pad to fast fft sizes, which doesn't affect the valid output
+    # fft of a symmetric window is real, i.e. of fft along x. rfft along y
+    mx, my = scipy.fft.next_fast_len(nx), scipy.fft.next_fast_len(ny, real=True)
+    win_f_x = _get_win_f(win, mx, torch.fft.fft, skip_x).real
+    win_f_y = _get_win_f(win, my, torch.fft.rfft, skip_y)
+    imgs_f = torch.fft.rfft2(imgs, s=(mx, my)) * (win_f_x[:, None] * win_f_y)
+    imgs = torch.fft.irfft2(imgs_f, s=(mx, my))[..., :nx, :ny]
+
+    if not skip_x:
+        imgs = imgs[..., r:nx-r, :]
+    if not skip_y:
+        imgs = imgs[..., r:ny-r]
+
+    return imgs
+
+def box_filter(imgs, size):
+    ''' mean over each size x size window of imgs [...,x,y], w/o padding, as
+        differences of cumulative sums, i.e. a running sum as scipy uniform_filter '''
+
+    for dim in [-2, -1]:
+        csum = torch.cumsum(imgs, dim=dim)
+        n = imgs.shape[dim]
+        imgs = torch.cat([csum.narrow(dim, size - 1, 1),
+                          csum.narrow(dim, size, n - size) - csum.narrow(dim, 0, n - size)],
+                         dim=dim) / size
+
+    return imgs
+
+def _get_win_f(win, n, fft, skip=False):
+    ''' fft of window zero-padded to n + centered at 0. if skip, of a delta '''
+
+    kernel = torch.zeros(n, dtype=win.dtype)
+    if skip:
+        kernel[0] = 1.
+        return fft(kernel)
+    kernel[:len(win)] = win
+
+    return fft(torch.roll(kernel, -(len(win) // 2)))
+
+def _pad_reflect(imgs, pad, dim):
+    ''' pad w scipy's 'reflect' mode, i.e. (d c b a | a b c d | d c b a), which
+        unlike torch's reflect mode repeats the edge sample '''
+
+    n = imgs.shape[dim]
+    return torch.cat([imgs.narrow(dim, 0, pad).flip(dim), imgs,
+                      imgs.narrow(dim, n - pad, pad).flip(dim)], dim=dim)
+
+def hfen_batch(gt, out, hfen):
+    ''' per-img HFENLoss()(gt, out) of imgs dim [n,x,y], i.e. mse of LoG filtered
+        imgs normalized by the norm of each out. in float32, as in calc_metrics '''
+
+    return hfen.forward_batch(gt[:, None].float(), out[:, None].float()).double()
@@ -7,25 +7,28 @@ from torch.fft import fftn, ifftn
 def reshape_adj_channels_to_complex_vals(arr):
     ''' reshape real tensor dim [2*nc,x,y] --> complex tensor dim [nc,x,y]
         assumes first nc sub-arrays are real, second nc are imag i.e. not alternating 
-        inverse operation of reshape_complex_vals_to_adj_channels() '''
+        inverse operation of reshape_complex_vals_to_adj_channels() 
+        leading batch dims are preserved, e.g. [n,2*nc,x,y] --> [n,nc,x,y] '''
 
     assert not is_complex(arr) # input should be real-valued
 
-    nc = int(arr.shape[0] // 2) # num_channels
-    arr_out = torch.empty((nc, arr.shape[1], arr.shape[2]), dtype=torch.complex64)
-    arr_out.real = arr[0:nc]
-    arr_out.imag = arr[nc:2*nc]
+    nc = int(arr.shape[-3] // 2) # num_channels
+    arr_out = torch.empty(arr.shape[:-3] + (nc,) + arr.shape[-2:], 
+                          dtype=torch.complex64, device=arr.device)
+    arr_out.real = arr[..., 0:nc, :, :]
+    arr_out.imag = arr[..., nc:2*nc, :, :]
         
     return arr_out
 
 def reshape_complex_vals_to_adj_channels(arr):
     ''' reshape complex tensor dim [nc,x,y] --> real tensor dim [2*nc,x,y]
         s.t. concat([nc,x,y] real, [nc,x,y] imag), i.e. not alternating real/imag 
-        inverse operation of reshape_adj_channels_to_complex_vals() '''
+        inverse operation of reshape_adj_channels_to_complex_vals() 
+        leading batch dims are preserved, e.g. [n,nc,x,y] --> [n,2*nc,x,y] '''
 
     assert is_complex(arr) # input should be complex-valued
     
-    return torch.cat([torch.real(arr), torch.imag(arr)])
+    return torch.cat([torch.real(arr), torch.imag(arr)], dim=-3)
 
 def crop_center(arr, crop_x, crop_y):
     ''' given 2D npy array, crop center area according to given dimns cropx, cropy '''
@@ -69,6 +72,35 @@ def root_sum_squares(arr):
     assert is_complex(arr)
     return torch.sqrt(torch.sum(torch.square(abs(arr)), axis=0))
 
+def get_coil_compression(ksp, num_vcoils=None, energy=None, num_groups=1):
+    ''' svd coil compression: return matrix dim (nc, num_groups*nv) w orthonormal
+        columns, s.t. virtual coils are cc_mat^H @ coils. see coil_compress()
+        ksp: complex k-space dim (nc,x,y), e.g. only the measured samples 
+        num_vcoils: number of virtual coils nv per group
+        energy: ... or smallest nv which keeps this fraction of energy, e.g. 0.95
+        num_groups: compress each contiguous group of coils separately, e.g. 2
+                    for qdess s.t. virtual coils stay split as [echo1 | echo2] '''
+
+    assert is_complex(ksp)
+    assert (num_vcoils is None) != (energy is None) # specify exactly one
+
+    U_list, S_list = [], []
+    for ksp_g in torch.chunk(ksp, num_groups, dim=0):
+        U, S, _ = torch.linalg.svd(ksp_g.reshape(ksp_g.shape[0], -1), full_matrices=False)
+        U_list.append(U)
+        S_list.append(S)
+
+    if num_vcoils is None: # same nv for each group, s.t. all keep >= energy
+        num_vcoils = max(int(torch.sum(torch.cumsum(S**2, 0) / torch.sum(S**2) < energy)) + 1 
+                         for S in S_list)
+        num_vcoils = min(num_vcoils, min(len(S) for S in S_list))
+
+    return torch.block_diag(*[U[:, :num_vcoils] for U in U_list])
+
+def coil_compress(ksp, cc_mat):
+    ''' given k-space (or img) dim (nc,x,y), return virtual coils dim (nv,x,y) '''
+    return torch.einsum('cv,cxy->vxy', cc_mat.conj(), ksp)
+
 def is_complex(arr):
     dt = arr.dtype
     return dt==torch.complex64 or dt==torch.complex128 or dt==torch.complex32